@@ -3,25 +3,44 @@ import tornado.httpserver
 import tornado.options
 import tornado.web
 from tornado.ioloop import IOLoop
+from tornado.log import app_log
 from tornado.options import define, options
 
 from .settings import settings
 from .urls import url_patterns
+from .contrib import templating
 
 define("bind", default='127.0.0.1', help="bind address", type=str)
 define("port", default=8888, help="run on the given port", type=int)
 define("debug", default=False, help="debug mode", type=bool)
+define("warm_up", default=True, help="compile all templates before listening", type=bool)
+define("compile_templates", default=False,
+       help="compile the Jinja2 templates into python modules and exit", type=bool)
 
 
 class Application(tornado.web.Application):
     def __init__(self):
         tornado.web.Application.__init__(self, url_patterns, **settings)
 
+    def warm_up(self):
+        stats = templating.warm_up(self.settings['template_path'],
+                                   self.settings.get('template_loader'),
+                                   templating.environment_from_settings(self.settings))
+        app_log.info("Templates compiled in %.2fs: %d tornado, %d jinja2, %d skipped",
+                     stats['seconds'], stats['tornado'], stats['jinja2'], stats['failed'])
+
 
 def main():
     tornado.options.parse_command_line()
 
+    if options.compile_templates:
+        app_log.info("Templates compiled into %s", templating.compile_templates(settings))
+        return
+
     app = Application()
+    # Only listen once warm: nginx skips a worker that refuses connections
+    if options.warm_up:
+        app.warm_up()
     server = tornado.httpserver.HTTPServer(app)
     server.listen(options.port, address='127.0.0.1')
     IOLoop.current().start()
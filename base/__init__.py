@@ -1,55 +1,99 @@
+import io
 import sys
+import asyncio
+import inspect
+import csv
+import time
+import itertools
 import functools
 import concurrent.futures
 
-import bcrypt
 import lazy_object_proxy
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
+from jinja2 import TemplateNotFound
 
 import tornado.web
 import tornado.escape
 from tornado.web import HTTPError, Finish
 from tornado import httputil
-from tornado.concurrent import run_on_executor
+from tornado.ioloop import IOLoop
 from tornado.log import app_log, gen_log
 
 from contrib import torndb
-from contrib.session import Session, InvalidSesssionID
-from utils.text import force_bytes
+from contrib.querycache import QueryCache
+from contrib.dbrouter import ReplicaSet
+from contrib.dbstats import QueryStats
+from contrib.hashers import PasswordHasher, HasherBusy
+from contrib.permissions import normalize_permissions, load_permissions
+from contrib.templating import environment_from_settings
+from contrib.session import Session, AsyncSession, CookieSession, SessionIndex, InvalidSesssionID
+from utils.escape import json_encode
 
 
 def permission_required(permisions=None, raise_exception=True):
     """Decorate methods with this to require permisions
+
+    The permissions are combined with the handler's ``permission_required``
+    once, when the handler class is defined (see `BaseHandler.__init_subclass__`).
     """
+    method_perms = normalize_permissions(permisions, 'permisions')
+
     def decorator(method):
         @functools.wraps(method)
         def wrapper(self, *args, **kwargs):
-            if self.permission_required is None:
-                perms = []
-            elif isinstance(self.permission_required, str):
-                perms = [self.permission_required]
-            elif isinstance(self.permission_required, (list, tuple)):
-                perms = list(self.permission_required)
-            else:
-                raise ValueError('permission_required must be str, list, tuple')
+            perms = self._resolved_permissions.get(wrapper)
+            if perms is None:
+                perms = normalize_permissions(self.permission_required, 'permission_required')
+                perms |= method_perms
+            if perms and not self.has_perms(perms, raise_exception=raise_exception):
+                raise HTTPError(status_code=403, log_message='PermissionDenied')
+            return method(self, *args, **kwargs)
+        wrapper.required_permissions = method_perms
+        return wrapper
+    return decorator
 
-            if permisions is not None:
-                if isinstance(permisions, str):
-                    perms.append(permisions)
-                elif isinstance(permisions, (list, tuple)):
-                    perms.extend(permisions)
-                else:
-                    raise ValueError('permisions must be str, list, tuple')
 
-            if perms:
-                has_perm = functools.partial(self.has_perm, raise_exception=raise_exception)
-                if not all(map(has_perm, perms)):
-                    raise HTTPError(status_code=403, log_message='PermissionDenied')
-            return method(self, *args, **kwargs)
+def cache_response(ttl=60, query_args=(), vary_headers=(), vary_cookies=()):
+    """Decorate GET methods with this to cache whole responses
+
+    Uses settings['response_cache'] (a contrib.responsecache.ResponseCache).
+    The key is the request path plus the given query arguments, request
+    headers and cookies.  Only 200 responses that set no cookie and were not
+    flushed early are stored; hits are answered with their strong ETag and
+    304 when the client already has them.  Requests from logged in users or
+    carrying a session, xsrf or flash cookie are never cached.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            cache = self.settings.get('response_cache')
+            if cache is not None and self.request.method == 'GET' \
+                    and not self._bypass_response_cache():
+                key = cache.key(
+                    self.request.path,
+                    [(name, self.get_query_arguments(name)) for name in query_args],
+                    [self.request.headers.get(name) for name in vary_headers],
+                    [self.get_cookie(name) for name in vary_cookies])
+                entry, token = cache.get_response(key)
+                if entry is not None:
+                    self._write_cached_response(entry)
+                    return
+                self._response_cache_pending = (cache, key, ttl, token)
+            result = method(self, *args, **kwargs)
+            if inspect.isawaitable(result):
+                await result
         return wrapper
     return decorator
 
 
+async def _iter_batches(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
 class SessionError(Exception):
     """ 请求缺少session id """
     pass
@@ -58,17 +102,60 @@ class SessionError(Exception):
 class BaseHandler(tornado.web.RequestHandler):
 
     executor = concurrent.futures.ThreadPoolExecutor(2)
+    # load_current_user专用, 避免与run_on_executor的慢任务互相排队
+    user_executor = concurrent.futures.ThreadPoolExecutor(4, thread_name_prefix='load-user')
     permission_required = None
+    # {被permission_required装饰的方法: 所需权限}, 在定义handler类时计算
+    _resolved_permissions = {}
+    # QueryStats for this request when settings['database']['instrument'] is set
+    db_stats = None
+    # 有这些cookie的请求不使用cache_response, 另外还有带session id或Authorization的请求
+    response_cache_bypass_cookies = ('userId', '_xsrf', 'flash_messages')
+    # (cache, key, ttl, token): 由cache_response设置, finish()时保存响应
+    _response_cache_pending = None
+    # finish()等待AsyncSession保存时的future; 保存完成后为True
+    _session_saving = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        perms = normalize_permissions(cls.permission_required, 'permission_required')
+        resolved = {}
+        for klass in cls.__mro__:
+            for method in vars(klass).values():
+                # 外层装饰器(如 gen.coroutine)包住的 permission_required wrapper 也要登记
+                seen = set()
+                while method is not None and id(method) not in seen:
+                    seen.add(id(method))
+                    required = getattr(method, 'required_permissions', None)
+                    if isinstance(required, frozenset):
+                        resolved[method] = perms | required
+                    method = getattr(method, '__wrapped__', None)
+        cls._resolved_permissions = resolved
 
     def _get_session_id(self):
         return self.get_cookie(self.settings['session']['session_id_name'])
 
-    def new_session(self):
-        setattr(self, '__session_manager', Session(self.settings['session']))
+    def new_session(self, asynchronous=False):
+        # Cookie mode always uses CookieSession, also for async handlers
+        if self.settings['session'].get('mode') == 'cookie':
+            session = CookieSession(self.settings['session'], self)
+        elif asynchronous:
+            session = AsyncSession(self.settings['session'])
+        else:
+            session = Session(self.settings['session'])
+        setattr(self, '__session_manager', session)
 
     def invalidate_session(self, session_id):
-        backend = self.settings['session']['backend']
-        backend.delete(session_id)
+        Session(self.settings['session'], session_id).delete()
+
+    def user_sessions(self, user_id):
+        """ 用户当前有效的session: [(session_id, 过期时间戳), ...] """
+        return SessionIndex.from_settings(self.settings['session']).sessions(user_id)
+
+    def revoke_user_sessions(self, user_id, keep_current=False):
+        """ 注销用户的所有session, keep_current为True时保留当前请求的session """
+        keep = self._get_session_id() if keep_current else None
+        return SessionIndex.from_settings(self.settings['session']).revoke(user_id, keep)
 
     @property
     def session(self):
@@ -77,27 +164,195 @@ class BaseHandler(tornado.web.RequestHandler):
             sid = self._get_session_id()
             if sid is None:
                 raise SessionError("缺少%s" % self.settings['session']['session_id_name'])
-            setattr(self, '__session_manager', Session(self.settings['session'], sid))
+            if self.settings['session'].get('mode') == 'cookie':
+                session = CookieSession(self.settings['session'], self, sid)
+            else:
+                session = Session(self.settings['session'], sid)
+            setattr(self, '__session_manager', session)
         return getattr(self, '__session_manager')
 
+    async def get_session(self):
+        """ Returns a loaded AsyncSession without blocking the IOLoop
+
+        `finish` saves it before the response completes, so the client's
+        next request sees the changes.
+
+        In cookie mode this is a loaded `CookieSession` instead, saved by
+        `finish` like with the `session` property.
+        """
+        if not hasattr(self, '__session_manager'):
+            sid = self._get_session_id()
+            if sid is None:
+                raise SessionError("缺少%s" % self.settings['session']['session_id_name'])
+            if self.settings['session'].get('mode') == 'cookie':
+                session = CookieSession(self.settings['session'], self, sid)
+            else:
+                session = AsyncSession(self.settings['session'], sid)
+            setattr(self, '__session_manager', session)
+        session = getattr(self, '__session_manager')
+        if isinstance(session, AsyncSession):
+            await session.load()
+        elif not session.loaded:
+            # A cookie session that spilled to Redis: read it off the IOLoop
+            session._session_cache = await IOLoop.current().run_in_executor(None, session.load)
+        return session
+
+    @property
+    def db_pool(self):
+        """ Returns the process-wide MySQL connection pool """
+        pool = getattr(self.application, 'db_pool', None)
+        if pool is None:
+            options = self.settings['database']
+            cache = None
+            if options.get('query_cache') is not None:
+                cache = QueryCache(self.settings['session']['backend'], **options['query_cache'])
+            if options.get('replicas'):
+                pool = ReplicaSet.from_settings(options, cache=cache)
+            else:
+                pool = torndb.ConnectionPool.from_settings(options, cache=cache)
+            self.application.db_pool = pool
+        return pool
+
     @property
     def db(self):
-        """ Returns a DB-API instance """
+        """ Returns a DB-API instance checked out of the pool
+
+        With replicas configured this is a `dbrouter.RoutedConnection`; a
+        client that wrote recently reads from the primary (see `finish`).
+        """
         if not hasattr(self, '__db'):
-            _db = self.settings['database']
-            db = torndb.Connection(
-                host=_db['host'], database=_db['db'],
-                user=_db['user'], password=_db['password']
-            )
-            setattr(self, '__db', db)
+            pool = self.db_pool
+            if isinstance(pool, ReplicaSet):
+                db = pool.connection(read_primary=self._read_primary())
+            else:
+                # Fails at once rather than block the IOLoop when the pool is
+                # exhausted; handlers that await while holding the connection
+                # should use get_db().
+                db = pool.connection()
+            self._use_db(db)
         return getattr(self, '__db')
 
+    async def get_db(self):
+        """ Like `db`, but waits for a free connection without blocking the IOLoop
+
+        Use it in coroutines that hold the connection across awaits
+        (``aquery``, ``aiter``/`stream_rows`, `render_stream`).
+        """
+        if not hasattr(self, '__db'):
+            pool = self.db_pool
+            if isinstance(pool, ReplicaSet):
+                # Routed connections check out lazily; their a*() methods wait
+                # with ConnectionPool.acquire().
+                db = pool.connection(read_primary=self._read_primary())
+            else:
+                db = await pool.acquire()
+            if hasattr(self, '__db'):
+                pool.release(db)
+            else:
+                self._use_db(db)
+        return getattr(self, '__db')
+
+    def _use_db(self, db):
+        instrument = self.settings['database'].get('instrument')
+        if instrument is not None:
+            self.db_stats = QueryStats(type(self).__name__, **instrument)
+            db.listener = self.db_stats
+        setattr(self, '__db', db)
+
+    def _read_primary(self):
+        until = self.get_cookie('db_primary')
+        try:
+            return until is not None and float(until) > time.time()
+        except ValueError:
+            return False
+
+    def finish(self, chunk=None):
+        session = getattr(self, '__session_manager', None)
+        if isinstance(session, AsyncSession) and session._session_cache is not None:
+            if self._session_saving is None:
+                # 先保存session再结束响应, 客户端的下一个请求才能读到修改
+                self._session_saving = asyncio.ensure_future(
+                    self._save_session_and_finish(session, chunk))
+            if self._session_saving is not True:
+                # 保存期间再次调用finish()(如_execute的auto finish)
+                return self._session_saving
+        db = getattr(self, '__db', None)
+        if getattr(db, 'wrote', False) and not self._headers_written:
+            # Read-your-writes: keep this client on the primary until the
+            # replicas have had time to catch up.
+            until = time.time() + self.settings['database'].get('sticky_seconds', 5)
+            self.set_cookie('db_primary', '%d' % until, expires=until, httponly=True)
+        session = getattr(self, '__session_manager', None)
+        if isinstance(session, CookieSession):
+            # The session lives in a cookie, so it must be saved while
+            # headers can still be sent.
+            if self._headers_written:
+                if session.modified:
+                    app_log.warning("Cookie session changed after headers were sent; not saved")
+            else:
+                session.save()
+        if self._response_cache_pending is not None and not self._headers_written:
+            if chunk is not None:
+                self.write(chunk)
+                chunk = None
+            self._store_response(*self._response_cache_pending)
+        return super().finish(chunk)
+
+    async def _save_session_and_finish(self, session, chunk):
+        try:
+            await session.save()
+        except Exception:
+            app_log.error("Cannot save session", exc_info=True)
+            self._session_saving = True
+            if not self._headers_written:
+                self.send_error(500)
+                return
+        self._session_saving = True
+        if not self._finished:
+            await self.finish(chunk)
+
+    def _bypass_response_cache(self):
+        # ApiHandler也接受?token=形式的session id, 所以不能只看cookie
+        if self._get_session_id() is not None or 'Authorization' in self.request.headers:
+            return True
+        return any(name in self.request.cookies for name in self.response_cache_bypass_cookies)
+
+    def _store_response(self, cache, key, ttl, token):
+        if self._status_code != 200 or getattr(self, '_new_cookie', None):
+            return
+        headers = [(name, value) for name, value in self._headers.get_all()
+                   if name not in ('Date', 'Server', 'Content-Length', 'Etag', 'Set-Cookie')]
+        entry = dict(status=self._status_code, headers=headers,
+                     body=b''.join(self._write_buffer), etag=self.compute_etag())
+        cache.set_response(key, entry, ttl, token)
+
+    def _write_cached_response(self, entry):
+        self.set_status(entry['status'])
+        for name in {name for name, _ in entry['headers']}:
+            self.clear_header(name)
+        for name, value in entry['headers']:
+            self.add_header(name, value)
+        self.set_header('Etag', entry['etag'])
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+        else:
+            self.finish(entry['body'])
+
     def _handle_request_exception(self, e):
         if isinstance(e, Finish):
             # Not an error; just finish the request without logging.
             if not self._finished:
                 self.finish(*e.args)
             return
+        elif isinstance(e, HasherBusy):
+            # Saturated by a login burst: fail fast, nothing to log
+            if not self._finished:
+                self.clear()
+                self.set_status(503)
+                self.set_header('Retry-After', self.password_hasher.retry_after)
+                self.finish()
+            return
         elif isinstance(e, (SessionError, InvalidSesssionID)):
             self.redirect(self.get_login_url())
         try:
@@ -133,7 +388,11 @@ class BaseHandler(tornado.web.RequestHandler):
         user_id = self.get_secure_cookie('userId')
         if not user_id:
             return
-        user = self.get_user(user_id)
+        cache = self.settings.get('user_cache')
+        if cache is not None:
+            user = cache.get(user_id, self.get_user)
+        else:
+            user = self.get_user(user_id)
         if not user:
             return
 
@@ -141,43 +400,142 @@ class BaseHandler(tornado.web.RequestHandler):
         user['profile'] = lazy_object_proxy.Proxy(_proxy)
         return user
 
-    @run_on_executor
-    def hashpw(self, password):
-        return bcrypt.hashpw(force_bytes(password), bcrypt.gensalt())
+    async def load_current_user(self):
+        """ 在user_executor中获取当前用户, 适合在async prepare()中调用:
+
+            async def prepare(self):
+                await self.load_current_user()
+
+        配置了user_cache时, 同一用户的并发请求只会查询一次数据库
+        """
+        self.current_user = await IOLoop.current().run_in_executor(
+            self.user_executor, self.get_current_user)
+        return self.current_user
+
+    def get_permissions(self, user_ids):
+        """ 批量查询用户的权限, 返回 {user_id: [codename, ...]}, 例如:
+
+            SELECT ur.user_id, rp.codename FROM user_role ur
+            JOIN role_permission rp ON rp.role_id = ur.role_id
+            WHERE ur.user_id IN %s
+        """
+        return {}
+
+    @property
+    def permissions(self):
+        """ 当前用户的权限集合, 每个请求只加载一次 """
+        if not hasattr(self, '_permissions'):
+            user_id = self.get_secure_cookie('userId') if self.current_user else None
+            if not user_id:
+                self._permissions = frozenset()
+            else:
+                user_id = user_id.decode('utf-8')
+                cache = self.settings.get('permission_cache')
+                if cache is not None:
+                    self._permissions = cache.get(user_id, self.get_permissions)
+                else:
+                    self._permissions = load_permissions(self.get_permissions, [user_id])[user_id]
+        return self._permissions
+
+    def has_perm(self, perm, raise_exception=False):
+        return self.has_perms([perm], raise_exception)
+
+    def has_perms(self, perms, raise_exception=False):
+        if self.permissions.issuperset(perms):
+            return True
+        if raise_exception:
+            raise HTTPError(status_code=403, log_message='PermissionDenied')
+        return False
+
+    def invalidate_permissions(self, *user_ids):
+        """ 用户的角色变化后调用; 不传user_ids时清除所有用户 (角色的权限变化后) """
+        cache = self.settings.get('permission_cache')
+        if cache is None:
+            return
+        if user_ids:
+            cache.invalidate(*user_ids)
+        else:
+            cache.invalidate_all()
 
-    @run_on_executor
-    def checkpw(self, password, hashed_pw):
-        return bcrypt.checkpw(force_bytes(password), force_bytes(hashed_pw))
+    def invalidate_user(self, user_id):
+        """ 用户信息修改后调用, 清除所有进程中的缓存 """
+        cache = self.settings.get('user_cache')
+        if cache is not None:
+            cache.invalidate(user_id)
+
+    @property
+    def password_hasher(self):
+        """ 进程内共享的bcrypt进程池 """
+        hasher = getattr(self.application, 'password_hasher', None)
+        if hasher is None:
+            hasher = PasswordHasher.from_settings(self.settings.get('password_hasher', {}))
+            self.application.password_hasher = hasher
+        return hasher
+
+    async def hashpw(self, password):
+        return await self.password_hasher.hashpw(password)
+
+    async def checkpw(self, password, hashed_pw, on_rehash=None):
+        """ 校验密码, 排队的任务过多时抛出HasherBusy (返回503)
+
+        如果hashed_pw的bcrypt cost与配置的rounds不同, 校验通过后重新计算hash,
+        并调用 on_rehash(new_hash) 保存, on_rehash可以是协程函数
+        """
+        hasher = self.password_hasher
+        ok = await hasher.checkpw(password, hashed_pw)
+        if ok and on_rehash is not None and hasher.needs_rehash(hashed_pw):
+            try:
+                result = on_rehash(await hasher.hashpw(password))
+                if inspect.isawaitable(result):
+                    await result
+            except HasherBusy:
+                # 下次登录时再更新
+                pass
+            except Exception:
+                app_log.error("Cannot rehash password", exc_info=True)
+        return ok
 
     def delay(self, method, *args, **kwargs):
         return self.executor.submit(functools.partial(method, *args, **kwargs))
 
     def on_finish(self):
         if hasattr(self, '__db'):
-            self.db.close()
+            self.db_pool.release(getattr(self, '__db'))
+            delattr(self, '__db')
+        if self.db_stats is not None:
+            self.db_stats.report()
         if hasattr(self, '__session_manager'):
-            self.session.save()
+            session = getattr(self, '__session_manager')
+            if not isinstance(session, (AsyncSession, CookieSession)):
+                session.save()
 
 
 class Jinja2Handler(BaseHandler):
 
-    def render_template(self, template_name, **kwargs):
-        template_dirs = []
-        if self.settings.get('template_path', ''):
-            template_dirs.append(
-                self.settings["template_path"]
-            )
+    @property
+    def jinja_env(self):
+        """ 进程内共享的Environment, 见 contrib.templating.get_environment """
+        return environment_from_settings(self.settings)
 
-        env = Environment(loader=FileSystemLoader(template_dirs))
+    def invalidate_fragments(self, prefix):
+        """ 清除key以prefix开头的 {% cache %} 片段缓存 """
+        fragment_cache = getattr(self.jinja_env, 'fragment_cache', None)
+        if fragment_cache is not None:
+            fragment_cache.invalidate(prefix)
 
+    def render_template(self, template_name, **kwargs):
         try:
-            template = env.get_template(template_name)
+            template = self.jinja_env.get_template(template_name)
         except TemplateNotFound:
             raise TemplateNotFound(template_name)
         content = template.render(kwargs)
         return content
 
-    def render(self, template_name, **kwargs):
+    # render_stream(): 第一次在输出这么多字节后flush (让<head>尽早到达浏览器), 之后每次
+    stream_first_flush = 4 * 1024
+    stream_flush_bytes = 64 * 1024
+
+    def get_template_context(self, kwargs):
         """
         This is for making some extra context variables available to
         the template
@@ -193,9 +551,36 @@ class Jinja2Handler(BaseHandler):
             'current_user': self.current_user,
             'xsrf_form_html': self.xsrf_form_html,
         })
-        content = self.render_template(template_name, **kwargs)
+        return kwargs
+
+    def render(self, template_name, **kwargs):
+        content = self.render_template(template_name, **self.get_template_context(kwargs))
         self.write(content)
 
+    async def render_stream(self, template_name, **kwargs):
+        """Renders a template with `jinja2.Template.generate` and streams it.
+
+        Output is flushed once ``stream_first_flush`` bytes are rendered, so
+        the ``<head>`` and the top of the page reach the browser early, and
+        then every ``stream_flush_bytes``; only one such chunk is held in
+        memory.  The status and headers are sent with the first flush, so
+        they (and cookies, including a `CookieSession`) cannot change while
+        the template renders.  Finishes the request.
+        """
+        template = self.jinja_env.get_template(template_name)
+        chunks, size, threshold = [], 0, self.stream_first_flush
+        for text in template.generate(self.get_template_context(kwargs)):
+            chunk = text.encode('utf-8')
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= threshold:
+                self.write(b''.join(chunks))
+                chunks, size, threshold = [], 0, self.stream_flush_bytes
+                await self.flush()
+        if chunks:
+            self.write(b''.join(chunks))
+        self.finish()
+
 
 class ApiHandler(BaseHandler):
 
@@ -211,19 +596,81 @@ class ApiHandler(BaseHandler):
             return self.get_json_argument(self.settings['session']['session_id_name'], None)
 
     def success(self, code=0, message='', **kwargs):
-        self.write({
+        self._write_json({
             'code': code,
             'message': message,
             'data': kwargs,
         })
 
     def failure(self, code=1, message='', **kwargs):
-        self.write({
+        self._write_json({
             'code': code,
             'message': message,
             'data': kwargs,
         })
 
+    def _write_json(self, value):
+        # tornado的json_encode不认识CompactRow和datetime, 用utils.escape的
+        self.set_header('Content-Type', self.STREAM_CONTENT_TYPES['json'])
+        self.write(json_encode(value))
+
+    STREAM_CONTENT_TYPES = {
+        'json': 'application/json; charset=UTF-8',
+        'ndjson': 'application/x-ndjson; charset=UTF-8',
+        'csv': 'text/csv; charset=UTF-8',
+    }
+
+    async def stream_rows(self, rows, format='json', batch_size=1000, filename=None):
+        """Streams a large result set to the client in chunks and finishes.
+
+        ``rows`` is either the async batch iterator returned by
+        `torndb.Connection.aiter` or any iterable of rows, such as the output
+        of `torndb.Connection.iter`.  Each batch is encoded as a JSON array,
+        NDJSON or CSV, written and flushed before the next one is fetched, so
+        memory use does not grow with the size of the result.
+        """
+        if format not in self.STREAM_CONTENT_TYPES:
+            raise ValueError('format must be one of %s' % ', '.join(self.STREAM_CONTENT_TYPES))
+        self.set_header('Content-Type', self.STREAM_CONTENT_TYPES[format])
+        if filename is not None:
+            self.set_header('Content-Disposition', 'attachment; filename="%s"' % filename)
+
+        if hasattr(rows, '__aiter__'):
+            batches = rows
+        else:
+            batches = _iter_batches(rows, batch_size)
+
+        encoder = getattr(self, '_encode_%s' % format)
+        first = True
+        try:
+            async for batch in batches:
+                self.write(encoder(batch, first))
+                first = False
+                await self.flush()
+        finally:
+            if hasattr(batches, 'aclose'):
+                await batches.aclose()
+        if format == 'json':
+            self.write('[]' if first else ']')
+        self.finish()
+
+    @staticmethod
+    def _encode_json(batch, first):
+        return ('[' if first else ',') + ','.join(map(json_encode, batch))
+
+    @staticmethod
+    def _encode_ndjson(batch, first):
+        return ''.join(json_encode(row) + '\n' for row in batch)
+
+    @staticmethod
+    def _encode_csv(batch, first):
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        if first:
+            writer.writerow(batch[0].keys())
+        writer.writerows(row.values() for row in batch)
+        return buf.getvalue()
+
     def _handle_request_exception(self, e):
         if isinstance(e, Finish):
             # Not an error; just finish the request without logging.
@@ -238,6 +685,14 @@ class ApiHandler(BaseHandler):
             self.failure(code=12000, message="无效的%s" % self.settings['session']['session_id_name'])
             self.finish()
             return
+        elif isinstance(e, HasherBusy):
+            if not self._finished:
+                self.clear()
+                self.set_status(503)
+                self.set_header('Retry-After', self.password_hasher.retry_after)
+                self.failure(code=13000, message="服务繁忙, 请稍后重试")
+                self.finish()
+            return
 
         try:
             self.log_exception(*sys.exc_info())
@@ -0,0 +1,287 @@
+import logging
+import itertools
+import threading
+
+import pymysql
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from contrib.torndb import ConnectionPool, PoolError
+
+
+# Methods of torndb.Connection that modify data.  Using any of them pins the
+# rest of the request to the primary.
+WRITE_METHODS = frozenset([
+    'execute', 'execute_lastrowid', 'execute_rowcount', 'executemany_rowcount',
+    'update', 'delete', 'updatemany', 'insert', 'insertmany',
+    'bulk_insert', 'load_data',
+])
+WRITE_METHODS |= frozenset('a' + name for name in WRITE_METHODS)
+
+
+class ReplicaSet:
+    """A primary `ConnectionPool` plus replica pools that serve reads.
+
+    `connection()` hands out a `RoutedConnection` with the interface of a
+    `torndb.Connection`; `release()` gives it back, like `ConnectionPool`.
+    Replicas are picked round-robin or by fewest connections in use, and a
+    periodic health check takes a replica out of rotation while it is
+    unreachable or lagging more than ``max_lag`` seconds behind.  With no
+    healthy replica left, reads go to the primary.
+    """
+    def __init__(self, primary, replicas, strategy='round_robin', max_lag=5,
+                 health_check_interval=10):
+        if strategy not in ('round_robin', 'least_connections'):
+            raise ValueError('strategy must be round_robin or least_connections')
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.health_check_interval = health_check_interval
+        self.healthy = {id(pool): True for pool in self.replicas}
+        self.lag = {id(pool): None for pool in self.replicas}
+        self._round_robin = itertools.cycle(self.replicas)
+        self._lock = threading.Lock()
+        self._checker = None
+
+    @classmethod
+    def from_settings(cls, options, **kwargs):
+        """Builds the set from a ``settings['database']`` style dict.
+
+        Each entry of ``options['replicas']`` is merged over the primary's
+        options, so usually only ``host`` needs to be given.
+        """
+        options = dict(options, **kwargs)
+        replicas = options.pop('replicas')
+        router_options = {}
+        for name in ('strategy', 'max_lag', 'health_check_interval'):
+            if 'replica_' + name in options:
+                router_options[name] = options.pop('replica_' + name)
+        primary = ConnectionPool.from_settings(options)
+        replica_pools = [ConnectionPool.from_settings(dict(options, **replica))
+                         for replica in replicas]
+        return cls(primary, replica_pools, **router_options)
+
+    def connection(self, read_primary=False):
+        """Returns a `RoutedConnection`; ``read_primary`` sends reads to the primary too."""
+        if self._checker is None and self.replicas and self.health_check_interval:
+            self.start_health_checks()
+        return RoutedConnection(self, read_primary)
+
+    def release(self, conn):
+        conn.release()
+
+    def choose_replica(self):
+        """Returns a healthy replica pool, or None if there is none."""
+        healthy = [pool for pool in self.replicas if self.healthy[id(pool)]]
+        if not healthy:
+            return None
+        if self.strategy == 'least_connections':
+            return min(healthy, key=lambda pool: pool.in_use)
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                pool = next(self._round_robin)
+                if self.healthy[id(pool)]:
+                    return pool
+        return None
+
+    def start_health_checks(self):
+        """Checks replica health every ``health_check_interval`` seconds."""
+        def check():
+            IOLoop.current().run_in_executor(None, self.check_health)
+        self._checker = PeriodicCallback(check, self.health_check_interval * 1000)
+        self._checker.start()
+
+    def check_health(self):
+        """Measures every replica's lag; blocking, run it off the IOLoop."""
+        for pool in self.replicas:
+            try:
+                lag = self._replica_lag(pool)
+            except PoolError:
+                # Busy is not down; keep the previous verdict.
+                continue
+            except pymysql.Error:
+                logging.warning("Replica %s is unreachable", pool.host, exc_info=True)
+                lag = None
+            healthy = lag is not None and lag <= self.max_lag
+            if healthy != self.healthy[id(pool)]:
+                logging.warning("Replica %s is now %s (lag %s)", pool.host,
+                                'healthy' if healthy else 'unhealthy', lag)
+            self.lag[id(pool)] = lag
+            self.healthy[id(pool)] = healthy
+
+    @staticmethod
+    def _replica_lag(pool):
+        conn = pool.connection()
+        try:
+            try:
+                status = conn.get("SHOW REPLICA STATUS")
+            except pymysql.ProgrammingError:
+                # MySQL before 8.0.22
+                status = conn.get("SHOW SLAVE STATUS")
+        finally:
+            pool.release(conn)
+        if status is None:
+            return None
+        if 'Seconds_Behind_Source' in status:
+            return status['Seconds_Behind_Source']
+        return status['Seconds_Behind_Master']
+
+    def close(self):
+        if self._checker is not None:
+            self._checker.stop()
+        self.primary.close()
+        for pool in self.replicas:
+            pool.close()
+
+    def stats(self):
+        return {
+            'primary': self.primary.stats(),
+            'replicas': [dict(pool.stats(), host=pool.host, healthy=self.healthy[id(pool)],
+                              lag=self.lag[id(pool)]) for pool in self.replicas],
+        }
+
+
+class RoutedConnection:
+    """A per-request connection that splits reads and writes.
+
+    `query`, `get` and `iter` (and their awaitable twins) run on one
+    replica chosen for the request; everything else, `cached` included,
+    runs on the primary.  After the first write, or between `begin` and
+    `commit`/`rollback`, reads go to the primary as well so that the request
+    sees its own changes.  ``wrote`` tells the caller whether the request
+    modified data (for read-your-writes stickiness across requests).
+
+    Connections are checked out on first use; the awaitable methods check
+    them out with `ConnectionPool.acquire`, so they never block the IOLoop
+    waiting for a busy pool.
+    """
+    def __init__(self, replica_set, read_primary=False):
+        self._replica_set = replica_set
+        self._read_primary = read_primary
+        self._primary = None
+        self._replica = None
+        self._replica_pool = None
+        self._in_transaction = False
+        self.wrote = False
+        self.listener = None
+
+    @property
+    def primary(self):
+        if self._primary is None:
+            self._primary = self._replica_set.primary.connection()
+            self._primary.listener = self.listener
+        return self._primary
+
+    async def _aprimary(self):
+        if self._primary is None:
+            conn = await self._replica_set.primary.acquire()
+            if self._primary is not None:
+                # Checked out by another coroutine in the meantime
+                self._replica_set.primary.release(conn)
+            else:
+                self._primary = conn
+                self._primary.listener = self.listener
+        return self._primary
+
+    def _reads_primary(self):
+        return self._read_primary or self._in_transaction or self.wrote
+
+    def _reader(self):
+        if self._reads_primary():
+            return self.primary
+        if self._replica is None:
+            pool = self._replica_set.choose_replica()
+            if pool is None:
+                return self.primary
+            self._use_replica(pool, pool.connection())
+        return self._replica
+
+    async def _areader(self):
+        if self._reads_primary():
+            return await self._aprimary()
+        if self._replica is None:
+            pool = self._replica_set.choose_replica()
+            if pool is None:
+                return await self._aprimary()
+            conn = await pool.acquire()
+            if self._replica is not None:
+                pool.release(conn)
+            else:
+                self._use_replica(pool, conn)
+        return self._replica
+
+    def _use_replica(self, pool, conn):
+        self._replica = conn
+        self._replica.listener = self.listener
+        self._replica_pool = pool
+
+    def query(self, query, *parameters, **kwparameters):
+        return self._reader().query(query, *parameters, **kwparameters)
+
+    def get(self, query, *parameters, **kwparameters):
+        return self._reader().get(query, *parameters, **kwparameters)
+
+    def iter(self, query, *parameters, **kwparameters):
+        return self._reader().iter(query, *parameters, **kwparameters)
+
+    async def aquery(self, query, *parameters, **kwparameters):
+        return await (await self._areader()).aquery(query, *parameters, **kwparameters)
+
+    async def aget(self, query, *parameters, **kwparameters):
+        return await (await self._areader()).aget(query, *parameters, **kwparameters)
+
+    async def aiter(self, query, *parameters, **kwparameters):
+        batches = (await self._areader()).aiter(query, *parameters, **kwparameters)
+        try:
+            async for batch in batches:
+                yield batch
+        finally:
+            await batches.aclose()
+
+    def cached(self, ttl=None, tags=None):
+        # A lagging replica would store pre-write rows under the versions a
+        # write just bumped, and every client would be served them for the
+        # whole TTL; so the cache is only filled from the primary.
+        return self.primary.cached(ttl, tags)
+
+    def begin(self):
+        self._in_transaction = True
+        self.primary.begin()
+
+    def commit(self):
+        self._in_transaction = False
+        self.primary.commit()
+
+    def rollback(self):
+        self._in_transaction = False
+        self.primary.rollback()
+
+    async def abegin(self):
+        self._in_transaction = True
+        await (await self._aprimary()).abegin()
+
+    async def acommit(self):
+        self._in_transaction = False
+        await (await self._aprimary()).acommit()
+
+    async def arollback(self):
+        self._in_transaction = False
+        await (await self._aprimary()).arollback()
+
+    def __getattr__(self, name):
+        if name in WRITE_METHODS:
+            self.wrote = True
+            if name.startswith('a'):
+                async def call(*args, **kwargs):
+                    return await getattr(await self._aprimary(), name)(*args, **kwargs)
+                return call
+        return getattr(self.primary, name)
+
+    def release(self):
+        """Returns the underlying connections to their pools."""
+        if self._replica is not None:
+            self._replica_pool.release(self._replica)
+            self._replica = self._replica_pool = None
+        if self._primary is not None:
+            self._replica_set.primary.release(self._primary)
+            self._primary = None
@@ -0,0 +1,87 @@
+import re
+import logging
+import functools
+import collections
+
+
+slow_log = logging.getLogger('torndb.slow')
+
+_FINGERPRINT_RULES = [
+    (re.compile(r"'(?:''|[^'\\]|\\.)*'|\"(?:\"\"|[^\"\\]|\\.)*\""), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'%\(\w+\)s|%s'), '?'),
+    (re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE), 'IN (?+)'),
+    # The rows of a multi-row INSERT
+    (re.compile(r'(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+'), r'\1+'),
+    (re.compile(r'\s+'), ' '),
+]
+_QUOTE = re.compile(r'[\'"]')
+_PARTIAL_ROW = re.compile(r'\s*,\s*\([^()]*$')
+
+# Longer statements (e.g. from bulk_insert) are fingerprinted by their head
+FINGERPRINT_MAX_LENGTH = 1024
+
+
+def fingerprint(sql):
+    """Reduces a statement to its shape: literals and placeholders become ``?``.
+
+    ``SELECT * FROM t WHERE id IN (1, 2, 3)`` and ``... IN (%s, %s)`` both
+    become ``SELECT * FROM t WHERE id IN (?+)``.  Only the first
+    `FINGERPRINT_MAX_LENGTH` characters are looked at; the fingerprint of a
+    longer statement ends with `` ...``.
+    """
+    if len(sql) <= FINGERPRINT_MAX_LENGTH:
+        return _fingerprint(sql)
+    head = _fingerprint(sql[:FINGERPRINT_MAX_LENGTH])
+    # Drop a string literal or row cut in half, it would make every statement unique
+    head = _PARTIAL_ROW.sub('', _QUOTE.split(head, 1)[0])
+    return head.rstrip() + ' ...'
+
+
+@functools.lru_cache(maxsize=2048)
+def _fingerprint(sql):
+    for pattern, replacement in _FINGERPRINT_RULES:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class QueryStats:
+    """Per-request record of the statements run through a `torndb.Connection`.
+
+    An instance is installed as the connection's ``listener`` and collects
+    ``(fingerprint, seconds, rowcount)`` for every statement.  Statements
+    slower than ``slow_threshold`` seconds are logged to ``torndb.slow`` as
+    they happen, and `report` warns about fingerprints repeated at least
+    ``n_plus_one_threshold`` times in the request, the usual sign of a
+    query issued once per row of a previous result (N+1).
+    """
+    def __init__(self, handler_name, slow_threshold=0.5, n_plus_one_threshold=5):
+        self.handler_name = handler_name
+        self.slow_threshold = slow_threshold
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.queries = []
+        self.total_time = 0.0
+        self.repeats = collections.Counter()
+
+    def __call__(self, sql, seconds, rowcount):
+        fp = fingerprint(sql)
+        self.queries.append((fp, seconds, rowcount))
+        self.total_time += seconds
+        self.repeats[fp] += 1
+        if seconds >= self.slow_threshold:
+            slow_log.warning("%.3fs %s rows=%s [%s]", seconds, fp, rowcount, self.handler_name)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    def n_plus_one(self):
+        """Returns ``[(fingerprint, times)]`` repeated beyond the threshold."""
+        return [(fp, n) for fp, n in self.repeats.most_common()
+                if n >= self.n_plus_one_threshold]
+
+    def report(self):
+        """Logs the request summary and any N+1 suspects."""
+        for fp, n in self.n_plus_one():
+            slow_log.warning("Possible N+1 in %s: %d x %s", self.handler_name, n, fp)
+        slow_log.debug("%s: %d queries in %.3fs", self.handler_name, self.count, self.total_time)
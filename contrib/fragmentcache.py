@@ -0,0 +1,182 @@
+import time
+import random
+import logging
+import collections
+
+import redis
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from contrib.sessioncache import LocalSessionCache
+from utils.text import force_text
+
+
+class LocalFragmentCache(LocalSessionCache):
+    """`LocalSessionCache` for `FragmentCache`; invalidations are key prefixes."""
+
+    channel = 'fragment-invalidate'
+
+    def _evict(self, prefix):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+            self._generation += 1
+
+
+class FragmentCache:
+    """Stores rendered template fragments in an in-process LRU and Redis.
+
+    Fragments live in ``fragment-<key>`` for their own TTL.  Every key is
+    also recorded in the sorted set ``fragment-keys`` with a score of 0, so
+    `invalidate` can find all keys starting with a prefix with one
+    ZRANGEBYLEX instead of scanning the keyspace.  ``fragment-expiry`` holds
+    the same keys scored by expiry time; about one write in ``prune_every``
+    removes expired keys from both sets.
+    """
+
+    key_prefix = 'fragment-'
+    index_key = 'fragment-keys'
+    expiry_key = 'fragment-expiry'
+    local_class = LocalFragmentCache
+
+    def __init__(self, backend, maxsize=1000, local_ttl=30, prune_every=100):
+        self.backend = backend
+        self.local = self.local_class(backend, maxsize, local_ttl) if local_ttl else None
+        self.prune_every = prune_every
+        self.counters = collections.Counter()
+
+    def get(self, key):
+        """Returns ``(fragment, token)``; pass the token to `set` after a miss."""
+        token = None
+        if self.local is not None:
+            hit = self.local.get(key)
+            if hit is not None:
+                return force_text(hit[0]), None
+            token = self.local.token()
+        try:
+            value = self.backend.get(self.key_prefix + key)
+        except redis.RedisError:
+            logging.warning("Fragment cache unavailable", exc_info=True)
+            self.counters['errors'] += 1
+            return None, token
+        if value is None:
+            self.counters['misses'] += 1
+            return None, token
+        self.counters['redis_hits'] += 1
+        if self.local is not None:
+            # The real TTL is unknown here; the local TTL bounds the staleness.
+            self.local.put(key, value, self.local.ttl, token)
+        return force_text(value), None
+
+    def set(self, key, fragment, ttl, token=None):
+        if self.local is not None and token is not None and token != self.local.token():
+            # Invalidated while rendering: the fragment may predate the change
+            return
+        now = time.time()
+        pipe = self.backend.pipeline(transaction=False)
+        pipe.set(self.key_prefix + key, fragment, ex=ttl)
+        pipe.zadd(self.index_key, {key: 0})
+        pipe.zadd(self.expiry_key, {key: now + ttl})
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            logging.warning("Cannot cache fragment %s", key, exc_info=True)
+            self.counters['errors'] += 1
+            return
+        if self.local is not None:
+            self.local.put(key, fragment.encode('utf-8'), ttl, token)
+        if self.prune_every and random.randrange(self.prune_every) == 0:
+            self.prune(now)
+
+    def prune(self, now=None):
+        """Drops the index entries of fragments that expired."""
+        expired = self.backend.zrangebyscore(self.expiry_key, '-inf', now or time.time())
+        if expired:
+            pipe = self.backend.pipeline(transaction=False)
+            pipe.zrem(self.index_key, *expired)
+            pipe.zrem(self.expiry_key, *expired)
+            pipe.execute()
+        return len(expired)
+
+    def invalidate(self, prefix):
+        """Deletes every fragment whose key starts with ``prefix``, in all workers."""
+        prefix = force_text(prefix)
+        encoded = prefix.encode('utf-8')
+        keys = self.backend.zrangebylex(self.index_key, b'[' + encoded, b'[' + encoded + b'\xff')
+        pipe = self.backend.pipeline(transaction=False)
+        if keys:
+            pipe.delete(*[self.key_prefix.encode() + key for key in keys])
+            pipe.zrem(self.index_key, *keys)
+            pipe.zrem(self.expiry_key, *keys)
+        if self.local is not None:
+            self.local.invalidate(prefix, pipe)
+        pipe.execute()
+        return len(keys)
+
+    def stats(self):
+        stats = dict(self.counters)
+        if self.local is not None:
+            stats['local'] = self.local.stats()
+        return stats
+
+
+class FragmentCacheExtension(Extension):
+    """Adds ``{% cache key, ttl %}...{% endcache %}`` to a Jinja2 environment.
+
+    The body is rendered once per ``ttl`` seconds and kept in the
+    environment's ``fragment_cache`` (a `FragmentCache`).  Further values
+    after ``ttl`` become part of the key, and ``vary_user=true`` /
+    ``vary_locale=true`` add the current user's id / the handler's locale::
+
+        {% cache 'sidebar', 300, category.id, vary_locale=true %}
+            ...
+        {% endcache %}
+
+    Parts are joined with ``:``, so ``fragment_cache.invalidate('sidebar')``
+    drops every variant.  Without a ``fragment_cache`` or with a ``ttl`` of
+    0 the body is simply rendered.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [nodes.ContextReference(), parser.parse_expression()]
+        parser.stream.expect('comma')
+        args.append(parser.parse_expression())
+        vary, kwargs = [], []
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.type == 'name' and parser.stream.look().type == 'assign':
+                name = parser.stream.current.value
+                parser.stream.skip(2)
+                kwargs.append(nodes.Keyword(name, parser.parse_expression()))
+            else:
+                vary.append(parser.parse_expression())
+        args.append(nodes.List(vary))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args, kwargs),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, context, name, ttl, vary, caller, vary_user=False, vary_locale=False):
+        cache = self.environment.fragment_cache
+        if cache is None or not ttl:
+            return caller()
+        parts = [str(name)]
+        if vary_user:
+            user = context.get('current_user')
+            parts.append('u=%s' % (user.get('id', '') if user else ''))
+        if vary_locale:
+            handler = context.get('handler')
+            parts.append('l=%s' % (handler.locale.code if handler is not None else ''))
+        parts.extend(str(value) for value in vary)
+        key = ':'.join(parts)
+        fragment, token = cache.get(key)
+        if fragment is None:
+            fragment = str(caller())
+            cache.set(key, fragment, int(ttl), token)
+        return Markup(fragment)
@@ -0,0 +1,121 @@
+import os
+import time
+import asyncio
+import logging
+import collections
+import multiprocessing
+import concurrent.futures
+
+import bcrypt
+
+from utils.text import force_bytes
+
+
+class HasherBusy(Exception):
+    """Too many hashing jobs are queued; the caller should retry later."""
+    pass
+
+
+def _hashpw(password, rounds):
+    started = time.time()
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)), started
+
+
+def _checkpw(password, hashed_pw):
+    started = time.time()
+    return bcrypt.checkpw(password, hashed_pw), started
+
+
+def bcrypt_rounds(hashed_pw):
+    """Returns the cost factor of a ``$2b$12$...`` hash, or None."""
+    try:
+        return int(force_bytes(hashed_pw).split(b'$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasher:
+    """Runs bcrypt in a dedicated process pool.
+
+    Every application process on the host has its own pool; by default the
+    cores are split between the ``processes`` of them, so the host runs one
+    hashing process per core.  Hashing neither holds the GIL of the IOLoop
+    process nor waits behind other executor work.  At most
+    ``max_pending`` jobs may be queued or running; beyond that `hashpw`
+    and `checkpw` raise `HasherBusy` at once instead of letting a login
+    burst pile up, and the handler answers 503 with a Retry-After header.
+
+    `stats` reports the queue depth and the queue wait / total latency
+    percentiles of recent jobs.
+    """
+
+    def __init__(self, rounds=12, workers=None, max_pending=None, retry_after=1, processes=1):
+        self.rounds = rounds
+        self.workers = workers or max((os.cpu_count() or 1) // processes, 1)
+        self.max_pending = max_pending or self.workers * 4
+        self.retry_after = retry_after
+        self.pending = 0
+        self.counters = collections.Counter()
+        # (queue wait, total) seconds of the most recent jobs
+        self._latencies = collections.deque(maxlen=1000)
+        self._pool = None
+
+    @classmethod
+    def from_settings(cls, options):
+        return cls(**options)
+
+    @property
+    def pool(self):
+        # Created on first use, i.e. after tornado forked its workers.  Spawned
+        # rather than forked since the process already runs threads.
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def _submit(self, fn, *args):
+        if self.pending >= self.max_pending:
+            self.counters['rejected'] += 1
+            raise HasherBusy('%d password hashing jobs pending' % self.pending)
+        self.pending += 1
+        submitted = time.time()
+        try:
+            result, started = await asyncio.wrap_future(self.pool.submit(fn, *args))
+        except concurrent.futures.BrokenExecutor:
+            logging.error("Password hashing pool broken, restarting it", exc_info=True)
+            self._pool = None
+            raise
+        finally:
+            self.pending -= 1
+        done = time.time()
+        self.counters['completed'] += 1
+        self._latencies.append((max(started - submitted, 0.0), done - submitted))
+        return result
+
+    async def hashpw(self, password):
+        return await self._submit(_hashpw, force_bytes(password), self.rounds)
+
+    async def checkpw(self, password, hashed_pw):
+        return await self._submit(_checkpw, force_bytes(password), force_bytes(hashed_pw))
+
+    def needs_rehash(self, hashed_pw):
+        """Whether ``hashed_pw`` was made with a cost other than ``rounds``."""
+        return bcrypt_rounds(hashed_pw) != self.rounds
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats.update(pending=self.pending, max_pending=self.max_pending, workers=self.workers)
+        for i, name in enumerate(('queue_wait', 'latency')):
+            values = sorted(latency[i] for latency in self._latencies)
+            if values:
+                stats[name] = {
+                    'p50': values[len(values) // 2],
+                    'p95': values[int(len(values) * 0.95)],
+                    'max': values[-1],
+                }
+        return stats
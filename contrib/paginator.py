@@ -1,7 +1,11 @@
 import re
+import json
+import base64
+import hashlib
 from math import floor, ceil
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 from utils.text import force_text, force_bytes
+from utils.escape import json_encode
 
 
 def url_replace_param(url, name, value):
@@ -106,3 +110,131 @@ def get_pagination_context(current_page, total, page_size, pages_to_show=11,
         'url_replace_param': url_replace_param,
     }
     return context
+
+
+class ExactCount:
+    """Counts with the query's own ``COUNT(*)``."""
+    def __call__(self, db, query):
+        sql, params = query.count(_as='total')
+        return db.get(sql, *params).total
+
+
+class CachedCount:
+    """Caches another count strategy's result in Redis for ``ttl`` seconds.
+
+    backend: a redis client, e.g. ``settings['session']['backend']``
+    """
+    key_prefix = 'count-'
+
+    def __init__(self, backend, ttl=60, counter=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.counter = counter or ExactCount()
+
+    def __call__(self, db, query):
+        sql, params = query.count()
+        key = self.key_prefix + hashlib.sha1(force_bytes(repr((sql, params)))).hexdigest()
+        total = self.backend.get(key)
+        if total is not None:
+            return int(total)
+        total = self.counter(db, query)
+        self.backend.set(key, total, self.ttl)
+        return total
+
+
+class EstimatedCount:
+    """Estimates the count from table statistics instead of scanning.
+
+    Unfiltered queries use ``information_schema.TABLES.TABLE_ROWS``, filtered
+    ones the optimizer's row estimate from ``EXPLAIN``.  Both are InnoDB
+    estimates and can be off by a wide margin; use them where an
+    approximate page count is acceptable.
+    """
+    def __call__(self, db, query):
+        if not query.filtered:
+            row = db.get('SELECT TABLE_ROWS AS total FROM information_schema.TABLES '
+                         'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                         query.table.strip('`'))
+            return int(row.total or 0) if row else 0
+        sql, params = query.count()
+        plan = db.query('EXPLAIN ' + sql, *params)
+        if not plan:
+            return 0
+        estimate = plan[0]['rows'] or 0
+        filtered = plan[0].get('filtered')
+        if filtered is not None:
+            estimate = estimate * float(filtered) / 100
+        return int(estimate)
+
+
+def encode_cursor(page, values, backward=False):
+    """Encodes a keyset position as an opaque, URL safe string."""
+    data = json_encode(['p' if backward else 'n', page, list(values)])
+    return force_text(base64.urlsafe_b64encode(force_bytes(data))).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns ``(page, values, backward)``; raises ValueError if malformed."""
+    try:
+        data = base64.urlsafe_b64decode(force_bytes(cursor) + b'=' * (-len(cursor) % 4))
+        direction, page, values = json.loads(force_text(data))
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('invalid pagination cursor')
+    if direction not in ('n', 'p') or not isinstance(page, int) or not isinstance(values, list):
+        raise ValueError('invalid pagination cursor')
+    return page, values, direction == 'p'
+
+
+def _row_key(row, keys):
+    return [row[column.split('.')[-1].strip('`')] for column, _ in keys]
+
+
+def paginate_keyset(db, query, page_size, cursor=None, count=None,
+                    url=None, extra=None, parameter_name='cursor'):
+    """
+    Keyset (seek) pagination of a `utils.sql.Query`
+    Returns the rows of the requested page and the same template context as
+    get_pagination_context, plus next_cursor/prev_cursor. Pages are reached
+    through the cursors only, so pages_back/pages_forward are always None.
+    query: 带order_by的Query, 排序列必须在select中且最后一列唯一
+    cursor: 上一次返回的next_cursor/prev_cursor, None为第一页
+    count: 计数策略 ExactCount/CachedCount/EstimatedCount, None为不计数
+    """
+    keys = query.ordering
+    if not keys:
+        raise ValueError('keyset pagination needs an order_by')
+
+    total = count(db, query) if count is not None else None
+
+    if cursor:
+        page, values, backward = decode_cursor(cursor)
+        query.seek(values, reverse=backward)
+    else:
+        page, backward = 1, False
+    query.limit(page_size + 1)
+    query.offset(None)
+
+    rows = db.query(*query)
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backward:
+        rows.reverse()
+        has_next, has_previous = True, has_more
+    else:
+        has_next, has_previous = has_more, page > 1
+
+    if total is None:
+        total = (page - 1) * page_size + len(rows) + (1 if has_next else 0)
+
+    context = get_pagination_context(page, total, page_size, pages_to_show=1, url=url,
+                                     extra=extra, parameter_name=parameter_name)
+    context.update({
+        'first_page': page,
+        'last_page': page,
+        'pages_shown': [page],
+        'pages_back': None,
+        'pages_forward': None,
+        'next_cursor': encode_cursor(page + 1, _row_key(rows[-1], keys)) if has_next and rows else None,
+        'prev_cursor': encode_cursor(page - 1, _row_key(rows[0], keys), True) if has_previous and rows else None,
+    })
+    return rows, context
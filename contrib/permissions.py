@@ -0,0 +1,112 @@
+import logging
+import collections
+
+import redis
+
+from contrib import serializers
+from utils.text import force_text
+
+
+def normalize_permissions(value, name='permissions'):
+    """Turns None, a codename or a list/tuple of codenames into a frozenset."""
+    if value is None:
+        return frozenset()
+    elif isinstance(value, str):
+        return frozenset([value])
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return frozenset(value)
+    raise ValueError('%s must be str, list, tuple' % name)
+
+
+def _user_key(user_id):
+    if isinstance(user_id, bytes):
+        user_id = force_text(user_id)
+    return str(user_id)
+
+
+def load_permissions(loader, user_ids):
+    """Calls a batch loader and returns ``{user_id: frozenset(codenames)}``.
+
+    The loader may key its result by ints (as a SQL query returns them)
+    or strings; either way it is matched to the requested ``user_ids``.
+    """
+    loaded = {}
+    for user_id, codenames in (loader(user_ids) or {}).items():
+        loaded.setdefault(_user_key(user_id), set()).update(codenames)
+    return {user_id: frozenset(loaded.get(_user_key(user_id), ())) for user_id in user_ids}
+
+
+class PermissionCache:
+    """Caches the permission codenames granted to each user in Redis.
+
+    ``perms-<user_id>`` holds the codenames together with the value of
+    ``perms-version`` they were loaded under; both are read with one MGET,
+    so `invalidate_all` (call it when the grants of a role change) makes
+    every entry stale at once without touching them.  Call `invalidate`
+    when the roles of particular users change.
+
+    Misses are loaded in one call to a batch loader taking a list of user
+    ids and returning ``{user_id: codenames}``.
+    """
+
+    key_prefix = 'perms-'
+    version_key = 'perms-version'
+    serializer = serializers.JSONSerializer()
+
+    def __init__(self, backend, ttl=3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.counters = collections.Counter()
+
+    def key(self, user_id):
+        return self.key_prefix + _user_key(user_id)
+
+    def get(self, user_id, loader):
+        return self.get_many([user_id], loader)[user_id]
+
+    def get_many(self, user_ids, loader):
+        """Returns ``{user_id: frozenset(codenames)}`` for every given user."""
+        user_ids = list(user_ids)
+        try:
+            values = self.backend.mget([self.version_key] + [self.key(u) for u in user_ids])
+        except redis.RedisError:
+            logging.warning("Permission cache unavailable", exc_info=True)
+            self.counters['errors'] += 1
+            return load_permissions(loader, user_ids)
+        version = int(values[0] or 0)
+        result = {}
+        for user_id, value in zip(user_ids, values[1:]):
+            if value is not None:
+                cached_version, codenames = serializers.loads(value, accept_pickle=False)
+                if cached_version == version:
+                    result[user_id] = frozenset(codenames)
+        self.counters['hits'] += len(result)
+        missing = [user_id for user_id in user_ids if user_id not in result]
+        if not missing:
+            return result
+        self.counters['misses'] += len(missing)
+        loaded = load_permissions(loader, missing)
+        pipe = self.backend.pipeline(transaction=False)
+        for user_id, codenames in loaded.items():
+            pipe.set(self.key(user_id),
+                     serializers.dumps([version, sorted(codenames)], self.serializer),
+                     ex=self.ttl)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            logging.warning("Cannot cache permissions", exc_info=True)
+            self.counters['errors'] += 1
+        result.update(loaded)
+        return result
+
+    def invalidate(self, *user_ids):
+        """Drops the cached grants of users whose roles changed."""
+        if user_ids:
+            self.backend.delete(*[self.key(user_id) for user_id in user_ids])
+
+    def invalidate_all(self):
+        """Makes every cached entry stale, e.g. after a role's grants changed."""
+        self.backend.incr(self.version_key)
+
+    def stats(self):
+        return dict(self.counters)
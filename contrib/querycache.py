@@ -0,0 +1,126 @@
+import re
+import pickle
+import hashlib
+import collections
+
+from utils.text import force_bytes
+
+
+_WHITESPACE = re.compile(r'\s+')
+_TABLES = re.compile(
+    r'\b(?:FROM|JOIN|UPDATE|INTO)\s+((?:`?\w+`?\.)?`?\w+`?(?:\s*,\s*(?:`?\w+`?\.)?`?\w+`?)*)',
+    re.IGNORECASE)
+
+
+class QueryCache:
+    """A Redis-backed result cache for `torndb.Connection` reads.
+
+    Entries are keyed on the normalized statement and its parameters and
+    tagged with the tables the statement reads.  Every tag has a version
+    counter in Redis; an entry stores the versions it was built from and is
+    only served while they are unchanged, so bumping a tag (which writes
+    through the same connection do automatically) invalidates every entry
+    that depends on it without having to find them.  A lookup is a single
+    pipelined round trip.
+
+        cache = QueryCache(settings['session']['backend'], ttl=60)
+        db = torndb.Connection(..., cache=cache)
+        rows = db.cached().query("SELECT * FROM regions")
+        db.execute("UPDATE regions SET ...")   # bumps the regions tag
+    """
+
+    key_prefix = 'qc-'
+    tag_prefix = 'qc-tag-'
+
+    def __init__(self, backend, ttl=60):
+        self.backend = backend
+        self.ttl = ttl
+        self.counters = collections.Counter()
+
+    @staticmethod
+    def normalize(sql):
+        return _WHITESPACE.sub(' ', sql).strip()
+
+    @staticmethod
+    def tables(sql):
+        """Returns the lowercase names of the tables a statement touches."""
+        tables = set()
+        for match in _TABLES.finditer(sql):
+            for name in match.group(1).split(','):
+                tables.add(name.strip().split('.')[-1].strip('`').lower())
+        return frozenset(tables)
+
+    def key(self, method, sql, parameters, kwparameters):
+        data = repr((method, self.normalize(sql), parameters, sorted(kwparameters.items())))
+        return self.key_prefix + hashlib.sha1(force_bytes(data)).hexdigest()
+
+    def fetch(self, loader, sql, parameters, kwparameters, ttl=None, tags=None):
+        """Returns the cached result of ``loader(sql, ...)``, loading it on a miss."""
+        key = self.key(loader.__name__, sql, parameters, kwparameters)
+        tags = sorted(tags or self.tables(sql))
+        tag_keys = [self.tag_prefix + tag for tag in tags]
+
+        pipe = self.backend.pipeline(transaction=False)
+        pipe.get(key)
+        if tag_keys:
+            pipe.mget(tag_keys)
+        replies = pipe.execute()
+        versions = replies[1] if tag_keys else []
+
+        if replies[0] is not None:
+            cached_versions, result = pickle.loads(replies[0])
+            if cached_versions == versions:
+                self.counters['hits'] += 1
+                return result
+            self.counters['stale'] += 1
+        self.counters['misses'] += 1
+
+        result = loader(sql, *parameters, **kwparameters)
+        self.backend.set(key, pickle.dumps((versions, result), pickle.HIGHEST_PROTOCOL),
+                         self.ttl if ttl is None else ttl)
+        return result
+
+    def invalidate(self, tags):
+        """Invalidates every entry tagged with any of ``tags``."""
+        pipe = self.backend.pipeline(transaction=False)
+        for tag in tags:
+            pipe.incr(self.tag_prefix + tag)
+        pipe.execute()
+        self.counters['invalidations'] += len(tags)
+
+    def stats(self):
+        stats = dict(self.counters)
+        lookups = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_ratio'] = stats.get('hits', 0) / lookups if lookups else 0.0
+        return stats
+
+    def view(self, db, ttl=None, tags=None):
+        return CachedQueries(self, db, ttl, tags)
+
+
+class CachedQueries:
+    """The `torndb.Connection.cached` view of a connection."""
+
+    def __init__(self, cache, db, ttl, tags):
+        self.cache = cache
+        self.db = db
+        self.ttl = ttl
+        self.tags = tags
+
+    def query(self, query, *parameters, **kwparameters):
+        if self.db._tx_tags is not None:
+            return self.db.query(query, *parameters, **kwparameters)
+        return self.cache.fetch(self.db.query, query, parameters, kwparameters,
+                                self.ttl, self.tags)
+
+    def get(self, query, *parameters, **kwparameters):
+        if self.db._tx_tags is not None:
+            return self.db.get(query, *parameters, **kwparameters)
+        return self.cache.fetch(self.db.get, query, parameters, kwparameters,
+                                self.ttl, self.tags)
+
+    async def aquery(self, query, *parameters, timeout=None, **kwparameters):
+        return await self.db._run(timeout, self.query, query, *parameters, **kwparameters)
+
+    async def aget(self, query, *parameters, timeout=None, **kwparameters):
+        return await self.db._run(timeout, self.get, query, *parameters, **kwparameters)
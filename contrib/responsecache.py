@@ -0,0 +1,42 @@
+import hashlib
+
+from contrib import serializers
+from contrib.fragmentcache import FragmentCache, LocalFragmentCache
+from utils.escape import json_encode
+
+
+class LocalResponseCache(LocalFragmentCache):
+    channel = 'response-invalidate'
+
+
+class ResponseCache(FragmentCache):
+    """Stores whole responses (status, headers, body and ETag) for `cache_response`.
+
+    Same layout as `FragmentCache`: an in-process LRU in front of Redis,
+    and keys starting with the request path, so ``invalidate('/news')``
+    drops every cached variant of the pages under ``/news``.
+    """
+
+    key_prefix = 'response-'
+    index_key = 'response-keys'
+    expiry_key = 'response-expiry'
+    local_class = LocalResponseCache
+    serializer = serializers.JSONSerializer()
+
+    @staticmethod
+    def key(path, query_args=(), headers=(), cookies=()):
+        vary = json_encode([list(query_args), list(headers), list(cookies)])
+        return '%s|%s' % (path, hashlib.sha1(vary.encode('utf-8')).hexdigest())
+
+    def get_response(self, key):
+        """Returns ``(entry, token)``; the entry is None on a miss."""
+        text, token = self.get(key)
+        if text is None:
+            self.counters['response_misses'] += 1
+            return None, token
+        self.counters['response_hits'] += 1
+        return serializers.loads(text.encode('utf-8'), accept_pickle=False), token
+
+    def set_response(self, key, entry, ttl, token=None):
+        text = serializers.dumps(entry, self.serializer).decode('utf-8')
+        self.set(key, text, ttl, token)
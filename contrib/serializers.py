@@ -0,0 +1,138 @@
+import json
+import base64
+import pickle
+import decimal
+import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class SerializationError(ValueError):
+    """Data could not be decoded by any known serializer."""
+    pass
+
+
+def _json_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__t': 'datetime', 'v': obj.isoformat()}
+    elif isinstance(obj, datetime.date):
+        return {'__t': 'date', 'v': obj.isoformat()}
+    elif isinstance(obj, decimal.Decimal):
+        return {'__t': 'decimal', 'v': str(obj)}
+    elif isinstance(obj, bytes):
+        return {'__t': 'bytes', 'v': base64.b64encode(obj).decode('ascii')}
+    elif isinstance(obj, (set, frozenset)):
+        return {'__t': 'set', 'v': list(obj)}
+    raise TypeError('%r is not JSON serializable' % type(obj))
+
+
+_JSON_TYPES = {
+    'datetime': datetime.datetime.fromisoformat,
+    'date': datetime.date.fromisoformat,
+    'decimal': decimal.Decimal,
+    'bytes': base64.b64decode,
+    'set': set,
+}
+
+
+def _json_object_hook(obj):
+    if len(obj) == 2 and '__t' in obj and 'v' in obj:
+        return _JSON_TYPES[obj['__t']](obj['v'])
+    return obj
+
+
+class JSONSerializer:
+    """JSON with typed extensions for datetime, date, Decimal, bytes and set.
+
+    Tuples come back as lists.
+    """
+    tag = b'j'
+
+    def dumps(self, value):
+        return json.dumps(value, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'), object_hook=_json_object_hook)
+
+
+class MsgpackSerializer:
+    """msgpack with the same typed extensions as `JSONSerializer`.
+
+    Requires the ``msgpack`` package.
+    """
+    tag = b'm'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError('MsgpackSerializer requires the msgpack package')
+
+    def dumps(self, value):
+        return msgpack.packb(value, default=_json_default, use_bin_type=True,
+                             datetime=False)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, object_hook=_json_object_hook, raw=False,
+                               strict_map_key=False)
+
+
+class PickleSerializer:
+    """Any picklable value.  Only use it for data the application wrote itself."""
+    tag = b'p'
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+_SERIALIZERS = {
+    'json': JSONSerializer,
+    'msgpack': MsgpackSerializer,
+    'pickle': PickleSerializer,
+}
+
+_by_tag = {}
+
+
+def get_serializer(name):
+    """Returns the serializer registered as ``name`` (json, msgpack or pickle)."""
+    try:
+        cls = _SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('unknown serializer %r' % name)
+    if cls.tag not in _by_tag:
+        _by_tag[cls.tag] = cls()
+    return _by_tag[cls.tag]
+
+
+def dumps(value, serializer):
+    """Serializes ``value`` and prefixes it with the serializer's tag.
+
+    The one byte tag names the format, so stored data stays readable after
+    the configured serializer changes.
+    """
+    return serializer.tag + serializer.dumps(value)
+
+
+def loads(data, accept_pickle=True):
+    """Decodes data written by `dumps` in any format, or legacy pickle data.
+
+    Untagged pickles (written before tags existed) start with ``\\x80`` and
+    are still understood, so old data migrates as it is rewritten.
+
+    With ``accept_pickle`` False pickled payloads are refused, which is
+    what should be used for anything that crossed a trust boundary.
+    """
+    tag = data[:1]
+    if tag == b'\x80' or tag == PickleSerializer.tag:
+        if not accept_pickle:
+            raise SerializationError('pickled data is not accepted')
+        return pickle.loads(data if tag == b'\x80' else data[1:])
+    for name, cls in _SERIALIZERS.items():
+        if cls.tag == tag:
+            return get_serializer(name).loads(data[1:])
+    raise SerializationError('unknown serialization format %r' % tag)
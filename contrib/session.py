@@ -1,65 +1,358 @@
-import pickle
+import os
+import time
+import base64
+import asyncio
+import logging
+import collections
+import struct
+import hashlib
 import secrets
 
+import redis
+
+from contrib import serializers
+from utils.text import force_bytes, force_text
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
 
 class InvalidSesssionID(Exception):
     """invalid session id"""
     pass
 
 
+class ExpiryRefresher:
+    """Batches session EXPIRE commands per IOLoop tick.
+
+    Every request that only needs to slide its session's expiry schedules
+    it here; the first one in a tick arranges a flush at the next
+    iteration, which sends all pending EXPIREs in one pipeline.  One
+    refresher exists per Redis client.  ``counters`` tracks how many
+    refreshes were skipped (``skipped``, the writes saved by
+    `Session.refresh_fraction`), merged (``coalesced``) and sent.
+    """
+
+    _instances = {}
+
+    def __init__(self, backend, asynchronous=False):
+        self.backend = backend
+        self.asynchronous = asynchronous
+        self.counters = collections.Counter()
+        self._pending = {}
+
+    @classmethod
+    def for_backend(cls, backend, asynchronous=False):
+        refresher = cls._instances.get(id(backend))
+        if refresher is None or refresher.backend is not backend:
+            refresher = cls._instances[id(backend)] = cls(backend, asynchronous)
+        return refresher
+
+    def schedule(self, key, seconds, index=None):
+        """Queues ``EXPIRE key seconds`` for the next flush.
+
+        ``index`` is an optional ``(index_key, session_id)`` pair whose
+        `SessionIndex` entry slides along with the session.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None and not self.asynchronous:
+            # Not inside an IOLoop, e.g. a script: nothing to batch with.
+            self._pending[key] = seconds, index
+            self._flush()
+            return
+        if key in self._pending:
+            self.counters['coalesced'] += 1
+        elif not self._pending:
+            if self.asynchronous:
+                loop.call_soon(lambda: loop.create_task(self._aflush()))
+            else:
+                loop.call_soon(self._flush)
+        self._pending[key] = seconds, index
+
+    def _take(self):
+        pending, self._pending = self._pending, {}
+        pipe = self.backend.pipeline(transaction=False)
+        now = time.time()
+        for key, (seconds, index) in pending.items():
+            pipe.expire(key, seconds)
+            if index is not None:
+                index_key, session_id = index
+                # XX: never resurrect an entry revoked in the meantime
+                pipe.zadd(index_key, {session_id: now + seconds}, xx=True)
+                pipe.expire(index_key, seconds)
+        self.counters['sent'] += len(pending)
+        self.counters['batches'] += 1
+        return pipe
+
+    def _flush(self):
+        try:
+            self._take().execute()
+        except redis.RedisError:
+            logging.warning("Cannot refresh session expiry", exc_info=True)
+
+    async def _aflush(self):
+        try:
+            await self._take().execute()
+        except redis.RedisError:
+            logging.warning("Cannot refresh session expiry", exc_info=True)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['pending'] = len(self._pending)
+        return stats
+
+
 class Session:
+    """A dict-like session stored in Redis under ``session-<id>``.
+
+    Two storage layouts are supported, chosen by ``settings['storage']``:
+
+    ``string`` (default)
+        the whole session serialized into one value, rewritten on change.
+    ``hash``
+        one Redis hash field per session key; only the keys that were set
+        or deleted during the request are written (HSET/HDEL).  Sessions
+        still stored as a single value are read and converted on their
+        next save.
+
+    Values are encoded with ``settings['serializer']`` (json, msgpack or
+    pickle, see `contrib.serializers`); data in any of these formats can
+    always be read, so the setting can be changed on a live system.
+    Changes made inside a mutable value (``session['cart'].append(x)``)
+    are only saved if the key is assigned again or ``modified`` is set.
+    """
 
     cache_key_prefix = 'session-'
     session_id_name = 'token'
     expire_seconds = 60 * 60 * 2
+    # Refresh the expiry once the remaining TTL drops below this share of it
+    refresh_fraction = 0.5
+    asynchronous = False
+    # Session key holding the user id set by bind_user()
+    user_field = '_user_id'
+    # Marks a hash-stored session as existing even when it has no keys
+    meta_field = '__session__'
+    hash_version = b'1'
 
     def __init__(self, settings, session_id=None):
         self.backend = settings['backend']
         self.expire_seconds = settings['expire_seconds']
         self.session_id_name = settings['session_id_name']
+        self.storage = settings.get('storage', 'string')
+        self.serializer = serializers.get_serializer(settings.get('serializer', 'pickle'))
+        self.accept_pickle = settings.get('accept_pickle', True)
+        self.refresh_fraction = settings.get('refresh_fraction', self.refresh_fraction)
+        # Oldest sessions of a user are revoked beyond this many; None for no cap
+        self.max_sessions_per_user = settings.get('max_sessions_per_user')
+        # contrib.sessioncache.LocalSessionCache shared by the process, if any
+        self.local_cache = settings.get('local_cache')
+        if self.storage not in ('string', 'hash'):
+            raise ValueError("session storage must be 'string' or 'hash'")
+        # Loaded from the backend on first access; None until then.
+        self._session_cache = None
+        self._ttl = None
+        # Keys set / deleted since loading, and whether to rewrite everything
+        self._dirty = set()
+        self._deleted = set()
+        self._rewrite = False
+        # User this session was bound to before bind_user() switched it
+        self._previous_user = None
         if session_id is None:
             self._new_session_id()
+            self._session_cache = {}
+            self._rewrite = True
         else:
-            self._check_session_id(session_id)
             self._session_id = session_id
-        self._session_cache = self.load()
         self.modified = False
 
     def _new_session_id(self):
         self._session_id = secrets.token_urlsafe()
         return self._session_id
 
-    def _check_session_id(self, sid):
-        if not self.backend.exists(self.cache_key_prefix + sid):
-            raise InvalidSesssionID("invalid session id")
-
     @property
     def cache_key(self):
         return self.cache_key_prefix + self._session_id
 
     @property
     def _session(self):
+        if self._session_cache is None:
+            self._session_cache = self.load()
         return self._session_cache
 
     @property
     def id(self):
         return self._session_id
 
+    @property
+    def index(self):
+        return SessionIndex(self.backend, self.cache_key_prefix, self.local_cache)
+
+    @property
+    def user_id(self):
+        return self.get(self.user_field)
+
+    def bind_user(self, user_id):
+        """Records the session as belonging to ``user_id``, usually on login.
+
+        Saving the session then adds it to the user's `SessionIndex` and
+        enforces ``max_sessions_per_user``.
+        """
+        user_id = str(user_id)
+        previous = self.get(self.user_field)
+        if previous is not None and previous != user_id:
+            self._previous_user = previous
+        self[self.user_field] = user_id
+
+    @property
+    def loaded(self):
+        return self._session_cache is not None
+
+    def _loads(self, data):
+        return serializers.loads(data, accept_pickle=self.accept_pickle)
+
+    def _dumps(self, value):
+        return serializers.dumps(value, self.serializer)
+
     def load(self):
-        session_data = self.backend.get(self.cache_key)
-        if session_data is not None:
-            return pickle.loads(session_data)
-        return {}
+        """Fetches the session data and its TTL in one round trip.
+
+        Raises InvalidSesssionID if the session does not exist (any more).
+        """
+        session = self._load_local()
+        if session is not None:
+            return session
+        token = self.local_cache.token() if self.local_cache is not None else None
+        pipe = self.backend.pipeline(transaction=False)
+        self._queue_load(pipe)
+        session_data, self._ttl = pipe.execute(raise_on_error=False)
+        if isinstance(session_data, redis.ResponseError):
+            # WRONGTYPE: still stored as a single value, convert on save
+            session_data = self.backend.get(self.cache_key)
+            self._rewrite = True
+        session = self._decode(session_data)
+        self._store_local(session_data, token)
+        return session
+
+    def _load_local(self):
+        if self.local_cache is None:
+            return None
+        hit = self.local_cache.get(self.cache_key)
+        if hit is None:
+            return None
+        session_data, self._ttl = hit
+        return self._decode(session_data)
+
+    def _store_local(self, session_data, token):
+        if self.local_cache is not None and not self._rewrite:
+            self.local_cache.put(self.cache_key, session_data, self._ttl, token)
+
+    def _queue_invalidate(self, pipe):
+        if self.local_cache is not None:
+            self.local_cache.invalidate(self.cache_key, pipe)
+
+    def _queue_load(self, pipe):
+        if self.storage == 'hash':
+            pipe.hgetall(self.cache_key)
+        else:
+            pipe.get(self.cache_key)
+        pipe.ttl(self.cache_key)
+
+    def _decode(self, session_data):
+        if isinstance(session_data, Exception):
+            raise session_data
+        if not session_data:
+            raise InvalidSesssionID("invalid session id")
+        if isinstance(session_data, dict):
+            meta = self.meta_field.encode()
+            return {name.decode('utf-8'): self._loads(value)
+                    for name, value in session_data.items() if name != meta}
+        return self._loads(session_data)
 
     def save(self):
-        if self.modified and self._session_id:
-            session_data = pickle.dumps(self._session)
-            self.backend.set(self.cache_key, session_data, self.expire_seconds)
-        elif self._session_cache:
-            self.set_expiry()
+        pipe = self.backend.pipeline()
+        if self._queue_save(pipe):
+            pipe.execute()
+            self._saved()
+
+    def _queue_save(self, pipe):
+        """Queues the commands that persist this request's changes.
+
+        Returns False when there is nothing to send.
+        """
+        if self._session_cache is None or not self._session_id:
+            # Never read nor written during this request (or flushed).
+            return False
+        if self.storage == 'hash':
+            if self.modified or (self._rewrite and self._session_cache):
+                self._queue_save_hash(pipe)
+                self._queue_invalidate(pipe)
+                self._queue_index(pipe)
+                return True
+        elif self.modified:
+            pipe.set(self.cache_key, self._dumps(self._session_cache), self.expire_seconds)
+            self._queue_invalidate(pipe)
+            self._queue_index(pipe)
+            return True
+        if self._session_cache:
+            self._refresh_expiry()
+        return False
+
+    def _refresh_expiry(self):
+        """Slides the expiry, but only once enough of the TTL has elapsed.
+
+        Refreshes are handed to the backend's `ExpiryRefresher`, which sends
+        all of them from one IOLoop tick in a single pipeline.  Returns
+        whether a refresh was scheduled.
+        """
+        refresher = ExpiryRefresher.for_backend(self.backend, self.asynchronous)
+        ttl = self._ttl
+        if ttl is not None and ttl >= 0 and ttl >= self.refresh_fraction * self.expire_seconds:
+            refresher.counters['skipped'] += 1
+            return False
+        user_id = self._session_cache.get(self.user_field)
+        index = (self.index.key(user_id), self._session_id) if user_id is not None else None
+        refresher.schedule(self.cache_key, self.expire_seconds, index)
+        return True
+
+    def _queue_index(self, pipe):
+        index = self.index
+        if self._previous_user is not None:
+            index.queue_discard(pipe, self._previous_user, self._session_id)
+            self._previous_user = None
+        user_id = self._session_cache.get(self.user_field)
+        if user_id is not None:
+            index.queue_add(pipe, user_id, self._session_id, self.expire_seconds,
+                            self.max_sessions_per_user)
+
+    def _queue_save_hash(self, pipe):
+        rewrite = self._rewrite or not (self._dirty or self._deleted)
+        keys = self._session_cache if rewrite else self._dirty
+        mapping = {key: self._dumps(self._session_cache[key]) for key in keys}
+        if rewrite:
+            pipe.delete(self.cache_key)
+            mapping[self.meta_field] = self.hash_version
+        elif self._deleted:
+            pipe.hdel(self.cache_key, *self._deleted)
+        if mapping:
+            pipe.hset(self.cache_key, mapping=mapping)
+        pipe.expire(self.cache_key, self.expire_seconds)
+
+    def _saved(self):
+        self._dirty.clear()
+        self._deleted.clear()
+        self._rewrite = False
+        self.modified = False
 
     def update(self, dict_):
         self._session.update(dict_)
+        self._dirty.update(dict_)
+        self._deleted.difference_update(dict_)
         self.modified = True
 
     def __contains__(self, key):
@@ -70,17 +363,27 @@ class Session:
 
     def __setitem__(self, key, value):
         self._session[key] = value
+        self._dirty.add(key)
+        self._deleted.discard(key)
         self.modified = True
 
     def __delitem__(self, key):
         del self._session[key]
+        self._dirty.discard(key)
+        self._deleted.add(key)
         self.modified = True
 
     def get(self, key, default=None):
         return self._session.get(key, default)
 
     def pop(self, key, default=None):
-        return self._session.pop(key, default)
+        if key not in self._session:
+            return default
+        value = self._session.pop(key)
+        self._dirty.discard(key)
+        self._deleted.add(key)
+        self.modified = True
+        return value
 
     def has_key(self, key):
         return key in self._session
@@ -99,15 +402,292 @@ class Session:
 
     def clear(self):
         self._session_cache = {}
+        self._dirty.clear()
+        self._deleted.clear()
+        self._rewrite = True
         self.modified = True
 
     def delete(self):
-        self.backend.delete(self.cache_key)
+        pipe = self.backend.pipeline(transaction=False)
+        self._queue_delete(pipe)
+        pipe.execute()
+
+    def _queue_delete(self, pipe):
+        pipe.delete(self.cache_key)
+        self._queue_invalidate(pipe)
+        if self._session_cache:
+            user_id = self._session_cache.get(self.user_field)
+            if user_id is not None:
+                self.index.queue_discard(pipe, user_id, self._session_id)
 
     def flush(self):
-        self.clear()
         self.delete()
+        self.clear()
         self._session_id = None
 
     def set_expiry(self, value=expire_seconds):
         self.backend.expire(self.cache_key, value)
+
+
+class AsyncSession(Session):
+    """A `Session` on an asyncio Redis client (``settings['async_backend']``).
+
+    The data must be loaded with ``await session.load()`` before it is used
+    (`BaseHandler.get_session` does that); afterwards the session is used
+    like a dict as usual, and ``await session.save()`` persists it in one
+    pipelined round trip without blocking the IOLoop.
+    """
+
+    asynchronous = True
+
+    def __init__(self, settings, session_id=None):
+        super().__init__(settings, session_id)
+        self.backend = settings['async_backend']
+
+    @property
+    def _session(self):
+        if self._session_cache is None:
+            raise RuntimeError("AsyncSession used before 'await session.load()'")
+        return self._session_cache
+
+    async def load(self):
+        if self._session_cache is not None:
+            return self._session_cache
+        session = self._load_local()
+        if session is None:
+            token = self.local_cache.token() if self.local_cache is not None else None
+            pipe = self.backend.pipeline(transaction=False)
+            self._queue_load(pipe)
+            session_data, self._ttl = await pipe.execute(raise_on_error=False)
+            if isinstance(session_data, redis.ResponseError):
+                session_data = await self.backend.get(self.cache_key)
+                self._rewrite = True
+            session = self._decode(session_data)
+            self._store_local(session_data, token)
+        self._session_cache = session
+        return session
+
+    async def save(self):
+        pipe = self.backend.pipeline()
+        if self._queue_save(pipe):
+            await pipe.execute()
+            self._saved()
+
+    async def delete(self):
+        pipe = self.backend.pipeline(transaction=False)
+        self._queue_delete(pipe)
+        await pipe.execute()
+
+    async def flush(self):
+        await self.delete()
+        self.clear()
+        self._session_id = None
+
+    async def set_expiry(self, value=Session.expire_seconds):
+        await self.backend.expire(self.cache_key, value)
+
+
+# KEYS[1]: index; ARGV: session id, its expiry, now, cap (0: none),
+# session key prefix, invalidation channel ('' for none), index TTL
+_INDEX_ADD_SCRIPT = """
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3])
+local evicted = {}
+local excess = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if tonumber(ARGV[4]) > 0 and excess > 0 then
+    evicted = redis.call('ZRANGE', KEYS[1], 0, excess - 1)
+    for _, session_id in ipairs(evicted) do
+        redis.call('DEL', ARGV[5] .. session_id)
+        if ARGV[6] ~= '' then
+            redis.call('PUBLISH', ARGV[6], ARGV[5] .. session_id)
+        end
+    end
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, excess - 1)
+end
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+return evicted
+"""
+
+
+class SessionIndex:
+    """The session ids of each user, so they can be listed and revoked.
+
+    ``session-user-<user_id>`` is a sorted set of the ids of the user's
+    sessions scored by when each expires.  A `Session` bound to a user with
+    `Session.bind_user` is added when it is saved and its score follows
+    the session's sliding expiry, so revoking every session of a user
+    never has to SCAN the keyspace.  Entries of sessions that expired or
+    were deleted behind the index's back are pruned lazily, whenever the
+    index is written or listed.
+
+    Sessions kept entirely in a cookie (`CookieSession`) are not indexed.
+    """
+
+    key_prefix = 'session-user-'
+
+    def __init__(self, backend, session_prefix='session-', local_cache=None):
+        self.backend = backend
+        self.session_prefix = session_prefix
+        self.local_cache = local_cache
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings['backend'], Session.cache_key_prefix, settings.get('local_cache'))
+
+    def key(self, user_id):
+        return self.key_prefix + str(user_id)
+
+    def queue_add(self, pipe, user_id, session_id, expire_seconds, limit=None):
+        """Queues adding a session, pruning expired entries and applying the cap.
+
+        When the user has more than ``limit`` sessions the ones closest to
+        expiring, i.e. the least recently used, are deleted.  It runs as
+        one script so concurrent logins cannot both slip under the cap.
+        """
+        now = time.time()
+        channel = self.local_cache.channel if self.local_cache is not None else ''
+        pipe.eval(_INDEX_ADD_SCRIPT, 1, self.key(user_id), session_id, now + expire_seconds,
+                  now, limit or 0, self.session_prefix, channel, expire_seconds)
+
+    def queue_discard(self, pipe, user_id, session_id):
+        pipe.zrem(self.key(user_id), session_id)
+
+    def sessions(self, user_id):
+        """Returns ``[(session_id, expires_at), ...]`` of the user's live sessions."""
+        key = self.key(user_id)
+        pipe = self.backend.pipeline(transaction=False)
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zrange(key, 0, -1, withscores=True)
+        entries = [(force_text(session_id), expires_at)
+                   for session_id, expires_at in pipe.execute()[1]]
+        if not entries:
+            return []
+        pipe = self.backend.pipeline(transaction=False)
+        for session_id, _ in entries:
+            pipe.exists(self.session_prefix + session_id)
+        alive = pipe.execute()
+        gone = [session_id for (session_id, _), exists in zip(entries, alive) if not exists]
+        if gone:
+            self.backend.zrem(key, *gone)
+        return [entry for entry, exists in zip(entries, alive) if exists]
+
+    def revoke(self, user_id, keep=None):
+        """Deletes every session of the user except ``keep``; returns how many."""
+        key = self.key(user_id)
+        session_ids = [force_text(session_id) for session_id in self.backend.zrange(key, 0, -1)]
+        session_ids = [session_id for session_id in session_ids if session_id != keep]
+        if not session_ids:
+            return 0
+        pipe = self.backend.pipeline()
+        for session_id in session_ids:
+            pipe.delete(self.session_prefix + session_id)
+            if self.local_cache is not None:
+                self.local_cache.invalidate(self.session_prefix + session_id, pipe)
+        pipe.zrem(key, *session_ids)
+        pipe.execute()
+        return len(session_ids)
+
+
+class CookieSession(Session):
+    """A session kept in the client's cookie instead of Redis.
+
+    The session is serialized as JSON, encrypted and authenticated with
+    AES-GCM under a key derived from ``cookie_secret``, and stored in the
+    session id cookie as ``c.<payload>``, so small sessions cost no Redis
+    round trip at all.  When the encrypted payload would exceed
+    ``cookie_max_bytes`` the session spills to Redis and the cookie holds
+    a plain session id, exactly like a `Session`; it moves back into the
+    cookie once it shrinks again.  A cookie that fails to decrypt or is
+    older than ``expire_seconds`` raises InvalidSesssionID.
+
+    The cookie has to be written before the response headers go out, so
+    `save` must be called before the request finishes (`BaseHandler.finish`
+    does that).  Requires the ``cryptography`` package.
+    """
+
+    cookie_prefix = 'c.'
+    cookie_version = b'\x01'
+
+    def __init__(self, settings, handler, cookie_value=None):
+        if AESGCM is None:
+            raise RuntimeError('CookieSession requires the cryptography package')
+        self.handler = handler
+        self.max_bytes = settings.get('cookie_max_bytes', 3000)
+        secret = handler.application.settings['cookie_secret']
+        self._aead = AESGCM(hashlib.sha256(b'session-cookie:' + force_bytes(secret)).digest())
+        self._issued = None
+        if cookie_value is not None and cookie_value.startswith(self.cookie_prefix):
+            super().__init__(settings)
+            self._session_cache = self._decrypt(cookie_value[len(self.cookie_prefix):])
+            self._rewrite = False
+            self.in_cookie = True
+        else:
+            # No cookie yet (new session) or a session that lives in Redis
+            super().__init__(settings, cookie_value)
+            self.in_cookie = cookie_value is None
+
+    def _encrypt(self, session):
+        nonce = os.urandom(12)
+        plaintext = struct.pack('>Q', int(time.time())) + serializers.dumps(
+            session, serializers.get_serializer('json'))
+        data = self.cookie_version + nonce + self._aead.encrypt(
+            nonce, plaintext, force_bytes(self.session_id_name))
+        return force_text(base64.urlsafe_b64encode(data)).rstrip('=')
+
+    def _decrypt(self, payload):
+        try:
+            data = base64.urlsafe_b64decode(force_bytes(payload) + b'=' * (-len(payload) % 4))
+            if data[:1] != self.cookie_version:
+                raise ValueError('unknown cookie session version')
+            plaintext = self._aead.decrypt(data[1:13], data[13:], force_bytes(self.session_id_name))
+            self._issued, = struct.unpack('>Q', plaintext[:8])
+            session = serializers.loads(plaintext[8:], accept_pickle=False)
+        except (ValueError, InvalidTag, struct.error):
+            raise InvalidSesssionID("invalid session id")
+        if self._issued + self.expire_seconds < time.time():
+            raise InvalidSesssionID("invalid session id")
+        return session
+
+    def save(self):
+        if self._session_cache is None or not self._session_id:
+            return
+        stale = self._issued is not None and self._issued + self.expire_seconds / 2 < time.time()
+        if not self.modified and not (self.in_cookie and stale):
+            if not self.in_cookie:
+                super().save()
+            return
+
+        payload = self._encrypt(self._session_cache)
+        if len(payload) + len(self.cookie_prefix) <= self.max_bytes:
+            if not self.in_cookie:
+                # Shrunk back under the limit: drop the Redis copy
+                self.delete()
+                self.in_cookie = True
+            self._set_cookie(self.cookie_prefix + payload)
+        else:
+            if self.in_cookie:
+                self._new_session_id()
+                self._rewrite = True
+                self.in_cookie = False
+                self.modified = True
+            super().save()
+            self._set_cookie(self._session_id)
+        self.modified = False
+
+    def _refresh_expiry(self):
+        # A spilled session: the id cookie must live as long as the Redis copy
+        refreshed = super()._refresh_expiry()
+        if refreshed:
+            self._set_cookie(self._session_id)
+        return refreshed
+
+    def _set_cookie(self, value):
+        self.handler.set_cookie(self.session_id_name, value, httponly=True,
+                                expires=time.time() + self.expire_seconds)
+
+    def flush(self):
+        if not self.in_cookie:
+            self.delete()
+        self.clear()
+        self.handler.clear_cookie(self.session_id_name)
+        self._session_id = None
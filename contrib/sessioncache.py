@@ -0,0 +1,142 @@
+import time
+import logging
+import threading
+import collections
+
+from utils.text import force_text
+
+
+class LocalSessionCache:
+    """An in-process LRU+TTL cache in front of the Redis session store.
+
+    It keeps the raw payload that `Session.load` read from Redis, so a
+    session used by several requests in a row is fetched once per worker.
+    Every save or delete publishes the session key on ``channel``; each
+    worker subscribes to it and drops its copy, so the other processes
+    behind nginx never serve stale data for long.
+
+    The cache is only consulted while the subscription is known to be up.
+    When pub/sub is unavailable, or after a reconnect (when invalidations
+    may have been missed), it is emptied and every read goes to Redis until
+    the subscription is confirmed again.  Entries also expire after ``ttl``
+    seconds as a last line of defence against lost messages.
+    """
+
+    channel = 'session-invalidate'
+
+    def __init__(self, backend, maxsize=10000, ttl=30):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.counters = collections.Counter()
+        self.listening = False
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Bumped on every eviction; see token()
+        self._generation = 0
+
+    def start(self):
+        """Subscribes to invalidations in a background thread (once)."""
+        with self._lock:
+            # Several threads (e.g. UserCache's callers) may get here at once
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._listen, name='session-invalidate',
+                                            daemon=True)
+            self._thread.start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.backend.pubsub()
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        # Anything published while we were away is lost.
+                        self.clear()
+                        self.listening = True
+                    elif message['type'] == 'message':
+                        self.counters['remote_invalidations'] += 1
+                        self._evict(force_text(message['data']))
+            except Exception:
+                if self.listening:
+                    logging.warning("Session invalidation channel lost, bypassing "
+                                    "the local cache", exc_info=True)
+                self.listening = False
+                self.clear()
+                self.counters['errors'] += 1
+                # Do not turn a Redis outage into a busy loop.
+                time.sleep(1)
+
+    def get(self, key):
+        """Returns ``(payload, ttl)`` for ``key``, or None on a miss."""
+        if self._thread is None:
+            self.start()
+        if not self.listening:
+            self.counters['bypassed'] += 1
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                expires_at, payload, redis_expires_at = entry
+                return payload, int(redis_expires_at - now)
+            if entry is not None:
+                del self._entries[key]
+        self.counters['misses'] += 1
+        return None
+
+    def token(self):
+        """Returns a token to take before reading from Redis and pass to `put`.
+
+        `put` refuses the payload if any invalidation arrived in between,
+        since the payload may predate it.
+        """
+        return self._generation
+
+    def put(self, key, payload, ttl, token):
+        """Caches a payload read from Redis whose remaining TTL is ``ttl``."""
+        if not self.listening or ttl is None or ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            if token != self._generation:
+                return
+            self._entries[key] = (now + min(self.ttl, ttl), payload, now + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def _evict(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+
+    def invalidate(self, key, pipe=None):
+        """Drops ``key`` here and in every other worker.
+
+        The PUBLISH is queued on ``pipe`` when given so it travels with the
+        write that made the entry stale; otherwise it is sent right away.
+        """
+        self._evict(key)
+        if pipe is None:
+            self.backend.publish(self.channel, key)
+        else:
+            pipe.publish(self.channel, key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['size'] = len(self._entries)
+        stats['listening'] = self.listening
+        lookups = stats.get('hits', 0) + stats.get('misses', 0) + stats.get('bypassed', 0)
+        stats['hit_ratio'] = stats.get('hits', 0) / lookups if lookups else 0.0
+        return stats
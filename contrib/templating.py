@@ -0,0 +1,124 @@
+import os
+import time
+import logging
+import threading
+
+from jinja2 import (Environment, FileSystemLoader, FileSystemBytecodeCache, ChoiceLoader,
+                    ModuleLoader)
+
+from contrib.fragmentcache import FragmentCacheExtension
+
+_environments = {}
+_lock = threading.Lock()
+
+
+def get_environment(template_path, debug=False, bytecode_cache_dir=None, cache_size=400,
+                    compiled_modules_dir=None, fragment_cache=None, **options):
+    """Returns the process-wide Jinja2 Environment for ``template_path``.
+
+    The environment keeps up to ``cache_size`` compiled templates in memory.
+    With ``bytecode_cache_dir`` the compiled code is also stored on disk
+    (`FileSystemBytecodeCache` writes atomically, so every worker can
+    share the directory), and a restarted worker loads the bytecode instead
+    of parsing and compiling each template again.  Templates are only
+    checked for changes on disk when ``debug`` is on.
+
+    Outside of ``debug``, templates precompiled into Python modules by
+    `compile_templates` are loaded from ``compiled_modules_dir`` first.
+
+    The ``{% cache %}`` tag is always available; it caches the fragments
+    in the `contrib.fragmentcache.FragmentCache` passed as
+    ``fragment_cache`` and simply renders them without one.
+
+    Extra keyword arguments are passed to `Environment` the first time the
+    environment for a given path is created.
+    """
+    template_dirs = [template_path] if isinstance(template_path, str) else list(template_path)
+    key = (tuple(template_dirs), bool(debug))
+    env = _environments.get(key)
+    if env is None:
+        with _lock:
+            env = _environments.get(key)
+            if env is None:
+                bytecode_cache = None
+                if bytecode_cache_dir:
+                    os.makedirs(bytecode_cache_dir, exist_ok=True)
+                    bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+                loader = FileSystemLoader(template_dirs)
+                if compiled_modules_dir and not debug:
+                    loader = ChoiceLoader([ModuleLoader(compiled_modules_dir), loader])
+                env = Environment(loader=loader,
+                                  bytecode_cache=bytecode_cache, cache_size=cache_size,
+                                  auto_reload=bool(debug), **_with_fragment_cache(options))
+                env.fragment_cache = fragment_cache
+                _environments[key] = env
+    return env
+
+
+def _with_fragment_cache(options):
+    options = dict(options)
+    options['extensions'] = list(options.get('extensions', ())) + [FragmentCacheExtension]
+    return options
+
+
+def environment_from_settings(settings):
+    """The environment for the application settings, as used by `Jinja2Handler`."""
+    return get_environment(settings.get('template_path', ''), debug=settings.get('debug', False),
+                           **settings.get('jinja2', {}))
+
+
+def iter_template_names(template_root, extensions=('.html', '.htm', '.xml', '.txt')):
+    """Yields the names (relative, ``/`` separated) of the templates under a root."""
+    for dirpath, dirnames, filenames in os.walk(template_root):
+        dirnames[:] = sorted(name for name in dirnames if not name.startswith('.'))
+        for filename in sorted(filenames):
+            if filename.endswith(extensions):
+                path = os.path.relpath(os.path.join(dirpath, filename), template_root)
+                yield path.replace(os.sep, '/')
+
+
+def warm_up(template_root, loader=None, env=None):
+    """Compiles every template under ``template_root`` before the first request.
+
+    ``loader`` is a `tornado.template.Loader` and ``env`` a Jinja2
+    Environment; the templates are loaded into each of them so that their
+    caches (and the Jinja2 bytecode cache) are filled.  A template written
+    for one engine usually fails to compile with the other, so failures
+    are only counted.  Returns a dict of counts and the elapsed seconds.
+    """
+    started = time.time()
+    stats = dict(tornado=0, jinja2=0, failed=0)
+    for name in iter_template_names(template_root):
+        for engine, load in (('tornado', loader and loader.load),
+                             ('jinja2', env and env.get_template)):
+            if load is None:
+                continue
+            try:
+                load(name)
+            except Exception:
+                logging.debug("Cannot compile %s with %s", name, engine, exc_info=True)
+                stats['failed'] += 1
+            else:
+                stats[engine] += 1
+    stats['seconds'] = time.time() - started
+    return stats
+
+
+def compile_templates(settings):
+    """Compiles the Jinja2 templates into ``settings['jinja2']['compiled_modules_dir']``.
+
+    Meant to run once per deploy, before the workers start.
+    """
+    options = dict(settings.get('jinja2', {}))
+    target = options.pop('compiled_modules_dir', None)
+    if not target:
+        raise ValueError("settings['jinja2']['compiled_modules_dir'] is not set")
+    for name in ('bytecode_cache_dir', 'cache_size', 'fragment_cache'):
+        options.pop(name, None)
+    # The compiled code must match the environment that will run it
+    env = Environment(loader=FileSystemLoader(settings['template_path']),
+                      **_with_fragment_cache(options))
+    # Templates Jinja2 cannot compile (tornado.template ones) are skipped
+    env.compile_templates(target, zip=None, ignore_errors=True,
+                          filter_func=lambda name: not name.startswith('.'))
+    return target
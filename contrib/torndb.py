@@ -1,6 +1,37 @@
+import os
 import time
+import asyncio
+import tempfile
 import logging
+import functools
+import itertools
+import threading
+import collections
+import concurrent.futures
+
 import pymysql
+from pymysql.constants import SERVER_STATUS
+
+
+# Size of the executor used for the a*() methods of connections that were
+# not given one of their own (pooled connections share the pool's executor).
+DEFAULT_EXECUTOR_WORKERS = 10
+
+_executor = None
+
+
+def get_executor():
+    """Returns the shared executor that runs blocking MySQL calls."""
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            DEFAULT_EXECUTOR_WORKERS, thread_name_prefix='torndb')
+    return _executor
+
+
+class QueryTimeout(Exception):
+    """An awaitable query did not finish within its timeout."""
+    pass
 
 
 class Connection:
@@ -18,14 +49,43 @@ class Connection:
 
     We explicitly set the timezone to UTC and assume the character encoding to
     UTF-8 (can be changed) on all connections to avoid time zone and encoding errors.
+
+    Every blocking method has an awaitable twin prefixed with ``a`` (`aquery`,
+    `aget`, `aexecute`, ...) that runs it on ``executor`` instead of the
+    IOLoop thread::
+
+        rows = await db.aquery("SELECT * FROM articles WHERE id > %s", 10,
+                               timeout=2)
+
+    ``timeout`` (falling back to ``query_timeout``) is reserved by the
+    awaitable methods and cannot be used as a named query parameter.  When it
+    expires, or the awaiting coroutine is cancelled, the running statement is
+    interrupted with ``KILL QUERY`` and `QueryTimeout` (or `CancelledError`)
+    is raised.  Awaitable calls on one connection are serialized.
+
+    Rows are built by ``row_factory``: `Row` (a dict) by default, or the more
+    compact `CompactRow` for wide or large results.  ``row_factory`` can also
+    be passed to `query`, `get` and `iter` (and their awaitable twins), so it
+    is reserved as a query parameter name as well.
     """
     def __init__(self, host, database, user=None, password=None,
                  max_idle_time=7 * 3600, connect_timeout=3,
                  time_zone="+8:00", charset="utf8", sql_mode="TRADITIONAL",
+                 executor=None, query_timeout=None, row_factory=None, cache=None,
                  **kwargs):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.executor = executor
+        self.query_timeout = query_timeout
+        self.row_factory = row_factory or Row
+        self.cache = cache
+        # Called as listener(query, seconds, rowcount) after every statement;
+        # see contrib.dbstats.QueryStats.
+        self.listener = None
+        self._tx_tags = None
+        self._async_lock = None
+        self._max_allowed_packet = None
 
         args = dict(charset=charset, db=database,
                     init_command=('SET time_zone = "%s"' % time_zone),
@@ -72,44 +132,74 @@ class Connection:
         self._db = pymysql.connect(**self._db_args)
         self._db.autocommit(True)
 
+    def ping(self):
+        """Checks that the server is still alive, reconnecting if it is not."""
+        if self._db is None:
+            self.reconnect()
+        else:
+            try:
+                self._db.ping(reconnect=False)
+            except pymysql.Error:
+                logging.warning("MySQL on %s went away, reconnecting", self.host)
+                self.reconnect()
+        self._last_use_time = time.time()
+
     def autocommit(self, value):
         self._db.autocommit(value)
 
     def begin(self):
         self._db.begin()
+        self._tx_tags = set()
 
     def rollback(self):
         self._db.rollback()
+        self._end_transaction()
 
     def commit(self):
         self._db.commit()
+        self._end_transaction()
+
+    def cached(self, ttl=None, tags=None):
+        """Returns a view whose `query`/`get` go through the result cache.
+
+        Requires a ``cache`` (`contrib.querycache.QueryCache`) on this
+        connection.  ``ttl`` overrides the cache's default and ``tags``
+        the table names parsed from the statement::
+
+            rows = db.cached(ttl=300).query("SELECT * FROM regions")
+
+        Inside a transaction the cache is bypassed.
+        """
+        if self.cache is None:
+            raise RuntimeError("Connection has no query cache configured")
+        return self.cache.view(self, ttl, tags)
 
-    def iter(self, query, *parameters, **kwparameters):
+    def iter(self, query, *parameters, row_factory=None, **kwparameters):
         """Returns an iterator for the given query and parameters."""
         self._ensure_connected()
         cursor = pymysql.cursors.SSCursor(self._db)
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
+            make_row = self._row_maker(cursor, row_factory)
             for row in cursor:
-                yield Row(zip(column_names, row))
+                yield make_row(row)
         finally:
             cursor.close()
 
-    def query(self, query, *parameters, **kwparameters):
+    def query(self, query, *parameters, row_factory=None, **kwparameters):
         """Returns a row list for the given query and parameters."""
         with self._cursor() as cursor:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
-            return [Row(zip(column_names, row)) for row in cursor]
+            make_row = self._row_maker(cursor, row_factory)
+            return [make_row(row) for row in cursor]
 
-    def get(self, query, *parameters, **kwparameters):
+    def get(self, query, *parameters, row_factory=None, **kwparameters):
         """Returns the (singular) row returned by the given query.
 
         If the query has no results, returns None.  If it has
         more than one result, raises an exception.
         """
-        rows = self.query(query, *parameters, **kwparameters)
+        rows = self.query(query, *parameters, row_factory=row_factory, **kwparameters)
         if not rows:
             return None
         elif len(rows) > 1:
@@ -127,12 +217,16 @@ class Connection:
         """Executes the given query, returning the lastrowid from the query."""
         with self._cursor() as cursor:
             self._execute(cursor, query, parameters, kwparameters)
+            if self.cache is not None:
+                self._invalidate(query)
             return cursor.lastrowid
 
     def execute_rowcount(self, query, *parameters, **kwparameters):
         """Executes the given query, returning the rowcount from the query."""
         with self._cursor() as cursor:
             self._execute(cursor, query, parameters, kwparameters)
+            if self.cache is not None:
+                self._invalidate(query)
             return cursor.rowcount
 
     def executemany_rowcount(self, query, parameters):
@@ -141,7 +235,14 @@ class Connection:
         We return the rowcount from the query.
         """
         with self._cursor() as cursor:
+            listener = self.listener
+            if listener is not None:
+                start = time.perf_counter()
             cursor.executemany(query, parameters)
+            if listener is not None:
+                listener(query, time.perf_counter() - start, cursor.rowcount)
+            if self.cache is not None:
+                self._invalidate(query)
             return cursor.rowcount
 
     update = delete = execute_rowcount
@@ -150,6 +251,229 @@ class Connection:
     insert = execute_lastrowid
     insertmany = executemany_rowcount
 
+    def bulk_insert(self, table, columns, rows, update=None, ignore=False,
+                    max_bytes=1024 * 1024, progress=None):
+        """Inserts an iterable of row tuples with multi-row INSERT statements.
+
+        ``rows`` may be a generator; it is consumed one statement at a time,
+        each holding as many rows as fit in ``max_bytes`` bytes of encoded
+        SQL (capped by the server's ``max_allowed_packet``), so memory stays
+        flat.  ``update``
+        is a list of columns to overwrite with ``ON DUPLICATE KEY UPDATE``.
+        ``progress`` is called with the running `BulkLoadStats` after every
+        statement.  Returns the final `BulkLoadStats`.
+        """
+        max_bytes = min(max_bytes, self._max_packet() - 1024)
+        verb = 'INSERT IGNORE' if ignore else 'INSERT'
+        prefix = '%s INTO %s (%s) VALUES ' % (verb, table, ', '.join(columns))
+        suffix = ''
+        if update:
+            suffix = ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+                '%s = VALUES(%s)' % (column, column) for column in update)
+
+        stats = BulkLoadStats()
+        # The packet limit is in bytes; non-ASCII text takes several per character
+        encoding = self._db.encoding
+        overhead = len((prefix + suffix).encode(encoding))
+        values, size = [], overhead
+        with self._cursor() as cursor:
+            for row in rows:
+                value = self._db.escape(tuple(row))
+                value_size = len(value.encode(encoding)) + 1
+                if values and size + value_size > max_bytes:
+                    self._bulk_execute(cursor, prefix + ','.join(values) + suffix,
+                                       len(values), size - 1, stats, progress)
+                    values, size = [], overhead
+                values.append(value)
+                size += value_size
+            if values:
+                self._bulk_execute(cursor, prefix + ','.join(values) + suffix,
+                                   len(values), size - 1, stats, progress)
+        if self.cache is not None:
+            self._invalidate(prefix)
+        return stats
+
+    def load_data(self, table, columns, rows, replace=False, chunk_rows=100000,
+                  progress=None):
+        """Streams rows into ``table`` with ``LOAD DATA LOCAL INFILE``.
+
+        This is the fastest way to import very large data sets.  Rows are
+        written to a temporary tab-separated file ``chunk_rows`` at a time and
+        each chunk is loaded with one statement, so neither memory nor disk
+        use grows with the input.  The connection must be created with
+        ``local_infile=True`` and the server must allow ``local_infile``.
+        """
+        sql = ("LOAD DATA LOCAL INFILE %%s %s INTO TABLE %s CHARACTER SET utf8mb4 "
+               "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+               "LINES TERMINATED BY '\\n' (%s)" % (
+                   'REPLACE' if replace else 'IGNORE', table, ', '.join(columns)))
+        stats = BulkLoadStats()
+        rows = iter(rows)
+        fd, path = tempfile.mkstemp(prefix='torndb-', suffix='.tsv')
+        os.close(fd)
+        try:
+            with self._cursor() as cursor:
+                while True:
+                    with open(path, 'w', encoding='utf-8', newline='') as f:
+                        count = 0
+                        for row in itertools.islice(rows, chunk_rows):
+                            f.write('\t'.join(map(_tsv_field, row)))
+                            f.write('\n')
+                            count += 1
+                    if not count:
+                        break
+                    cursor.execute(sql, (path,))
+                    stats.add(count, os.path.getsize(path))
+                    if progress is not None:
+                        progress(stats)
+        finally:
+            os.unlink(path)
+        if self.cache is not None:
+            self._invalidate('INTO ' + table)
+        return stats
+
+    def _bulk_execute(self, cursor, sql, count, size, stats, progress):
+        # No parameters: the values are already escaped, and passing any
+        # would make pymysql %-format the statement.  ``size`` is the
+        # statement's length in bytes, as counted by bulk_insert.
+        self._execute(cursor, sql, None, None)
+        stats.add(count, size)
+        if progress is not None:
+            progress(stats)
+
+    def _max_packet(self):
+        if self._max_allowed_packet is None:
+            row = self.get("SELECT @@max_allowed_packet AS size")
+            self._max_allowed_packet = int(row.size)
+        return self._max_allowed_packet
+
+    async def aiter(self, query, *parameters, batch_size=1000, timeout=None, **kwparameters):
+        """Awaitable `iter` that yields lists of up to ``batch_size`` rows.
+
+        Rows are fetched from the server-side cursor one batch at a time, so
+        memory stays flat however large the result is.  The connection must
+        not be used for anything else until the iteration is finished.
+        """
+        rows = self.iter(query, *parameters, **kwparameters)
+
+        def fetch():
+            return list(itertools.islice(rows, batch_size))
+        try:
+            while True:
+                batch = await self._run(timeout, fetch)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            await self._run(None, rows.close)
+
+    async def aquery(self, query, *parameters, timeout=None, **kwparameters):
+        """Awaitable `query`."""
+        return await self._run(timeout, self.query, query, *parameters, **kwparameters)
+
+    async def aget(self, query, *parameters, timeout=None, **kwparameters):
+        """Awaitable `get`."""
+        return await self._run(timeout, self.get, query, *parameters, **kwparameters)
+
+    async def aexecute(self, query, *parameters, timeout=None, **kwparameters):
+        """Awaitable `execute`."""
+        return await self._run(timeout, self.execute, query, *parameters, **kwparameters)
+
+    async def aexecute_lastrowid(self, query, *parameters, timeout=None, **kwparameters):
+        """Awaitable `execute_lastrowid`."""
+        return await self._run(timeout, self.execute_lastrowid, query, *parameters, **kwparameters)
+
+    async def aexecute_rowcount(self, query, *parameters, timeout=None, **kwparameters):
+        """Awaitable `execute_rowcount`."""
+        return await self._run(timeout, self.execute_rowcount, query, *parameters, **kwparameters)
+
+    async def aexecutemany_rowcount(self, query, parameters, timeout=None):
+        """Awaitable `executemany_rowcount`."""
+        return await self._run(timeout, self.executemany_rowcount, query, parameters)
+
+    async def abulk_insert(self, table, columns, rows, timeout=None, **kwargs):
+        """Awaitable `bulk_insert`; ``rows`` is consumed on the executor."""
+        return await self._run(timeout, self.bulk_insert, table, columns, rows, **kwargs)
+
+    async def aload_data(self, table, columns, rows, timeout=None, **kwargs):
+        """Awaitable `load_data`; ``rows`` is consumed on the executor."""
+        return await self._run(timeout, self.load_data, table, columns, rows, **kwargs)
+
+    aupdate = adelete = aexecute_rowcount
+    aupdatemany = aexecutemany_rowcount
+
+    ainsert = aexecute_lastrowid
+    ainsertmany = aexecutemany_rowcount
+
+    async def abegin(self):
+        return await self._run(None, self.begin)
+
+    async def arollback(self):
+        return await self._run(None, self.rollback)
+
+    async def acommit(self):
+        return await self._run(None, self.commit)
+
+    async def _run(self, timeout, method, /, *args, **kwargs):
+        call = functools.partial(method, *args, **kwargs)
+        if timeout is None:
+            timeout = self.query_timeout
+
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor or get_executor(), call)
+            try:
+                # shield() keeps the executor future alive so that we can
+                # wait for the worker thread to let go of the connection.
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                await self._interrupt(future)
+                raise QueryTimeout("query on %s exceeded %ss" % (self.host, timeout)) from None
+            except asyncio.CancelledError:
+                await self._interrupt(future)
+                raise
+
+    async def _interrupt(self, future):
+        """Kills the statement running for ``future`` and waits for it to end."""
+        if not future.done() and self._db is not None:
+            thread_id = self._db.thread_id()
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(None, self._kill_query, thread_id)
+            except pymysql.Error:
+                logging.warning("Cannot interrupt MySQL query %s on %s",
+                                thread_id, self.host, exc_info=True)
+        try:
+            await asyncio.shield(future)
+        except Exception:
+            pass
+
+    def _kill_query(self, thread_id):
+        args = dict(self._db_args)
+        args.pop("init_command", None)
+        conn = pymysql.connect(**args)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("KILL QUERY %d" % thread_id)
+        finally:
+            conn.close()
+
+    def _invalidate(self, query):
+        tags = self.cache.tables(query)
+        if tags:
+            self.cache.invalidate(tags)
+            if self._tx_tags is not None:
+                # Readers may refill the cache from the pre-transaction
+                # state before we commit; invalidate again at the end.
+                self._tx_tags.update(tags)
+
+    def _end_transaction(self):
+        tags, self._tx_tags = self._tx_tags, None
+        if tags and self.cache is not None:
+            self.cache.invalidate(tags)
+
     def _ensure_connected(self):
         # Mysql by default closes client connections that are idle for
         # 8 hours, but the client library does not report this fact until
@@ -165,13 +489,323 @@ class Connection:
         self._ensure_connected()
         return self._db.cursor()
 
+    def _row_maker(self, cursor, row_factory):
+        column_names = [d[0] for d in cursor.description]
+        return (row_factory or self.row_factory).maker(column_names)
+
     def _execute(self, cursor, query, parameters, kwparameters):
+        listener = self.listener
+        if listener is not None:
+            start = time.perf_counter()
         try:
             return cursor.execute(query, kwparameters or parameters)
         except pymysql.OperationalError:
             logging.error("Error connecting to MySQL on %s", self.host)
             self.close()
             raise
+        finally:
+            if listener is not None:
+                listener(query, time.perf_counter() - start, cursor.rowcount)
+
+
+class BulkLoadStats:
+    """Running totals of a `Connection.bulk_insert` or `load_data` call."""
+
+    def __init__(self):
+        self.rows = 0
+        self.statements = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def add(self, rows, size):
+        self.rows += rows
+        self.statements += 1
+        self.bytes += size
+        self.elapsed = time.time() - self.started
+        logging.debug("bulk load: %d rows in %d statements, %.0f rows/s",
+                      self.rows, self.statements, self.rows_per_sec)
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<BulkLoadStats rows=%d statements=%d %.0f rows/s>' % (
+            self.rows, self.statements, self.rows_per_sec)
+
+
+def _tsv_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return (value.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class PoolError(Exception):
+    """No connection could be checked out of a ConnectionPool in time."""
+    pass
+
+
+def _wake(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class ConnectionPool:
+    """A process-wide, bounded pool of `Connection` objects.
+
+    Connections are checked out with `connection()` and must be handed back
+    with `release()` once the caller is done with them::
+
+        pool = torndb.ConnectionPool("localhost", "mydatabase", max_size=10)
+        db = pool.connection()
+        try:
+            db.query("SELECT 1")
+        finally:
+            pool.release(db)
+
+    At most ``max_size`` connections are open at any time; ``min_size`` of
+    them are opened eagerly and kept around when idle.  A connection that has
+    been idle longer than ``ping_interval`` seconds is pinged before being
+    handed out, and one idle longer than ``max_idle_time`` is reopened (the
+    same rule `Connection._ensure_connected` applies).
+
+    When every connection is in use, `acquire()` waits up to ``timeout``
+    seconds without blocking the IOLoop, and `connection()` does the same
+    blocking wait on other threads; both then raise `PoolError`.  On the
+    IOLoop thread `connection()` raises at once instead: connections come
+    back from requests running on that very loop, so blocking it would
+    only stall the worker until the timeout.
+    """
+    def __init__(self, host, database, user=None, password=None,
+                 min_size=1, max_size=10, timeout=3, ping_interval=30,
+                 max_idle_time=7 * 3600, **kwargs):
+        if max_size < 1 or min_size > max_size:
+            raise ValueError("pool needs 0 <= min_size <= max_size and max_size >= 1")
+        self.host = host
+        self.database = database
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.ping_interval = float(ping_interval)
+        self.max_idle_time = float(max_idle_time)
+
+        self._conn_args = dict(host=host, database=database, user=user,
+                               password=password, max_idle_time=max_idle_time,
+                               **kwargs)
+        # Blocking calls made through the a*() methods run here, one worker
+        # per connection the pool may hand out.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_size, thread_name_prefix='torndb-%s' % database)
+        self._conn_args['executor'] = self.executor
+
+        self._idle = collections.deque()
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        # (loop, future) of coroutines waiting in acquire()
+        self._waiters = collections.deque()
+        self._stats = collections.Counter()
+
+        for _ in range(min_size):
+            self._idle.append(self._connect())
+
+    # Keys of ``settings['database']`` that configure the application, not the pool
+    settings_only = ('query_cache', 'sticky_seconds', 'instrument', 'replicas')
+
+    @classmethod
+    def from_settings(cls, options, **kwargs):
+        """Builds a pool from a ``settings['database']`` style dict.
+
+        Keys in `settings_only` and ``replica_*`` options are ignored.
+        """
+        options = dict(options, **kwargs)
+        for name in list(options):
+            if name in cls.settings_only or name.startswith('replica_'):
+                del options[name]
+        options['database'] = options.pop('db')
+        return cls(**options)
+
+    def _connect(self):
+        self._size += 1
+        self._stats['created'] += 1
+        return Connection(**self._conn_args)
+
+    def _take(self):
+        """Reserves an idle connection, or a slot for a new one (lock held).
+
+        Returns ``(True, conn)``, where conn is None for a new slot, or
+        ``(False, None)`` when every connection is in use.
+        """
+        if self._closed:
+            raise PoolError("pool is closed")
+        if self._idle:
+            # LIFO hands out the most recently used connection,
+            # which is the least likely to have gone stale.
+            return True, self._idle.pop()
+        if self._size < self.max_size:
+            self._size += 1
+            self._stats['created'] += 1
+            return True, None
+        return False, None
+
+    def _exhausted(self):
+        self._stats['timeouts'] += 1
+        return PoolError("no MySQL connection available on %s "
+                         "after %ss" % (self.host, self.timeout))
+
+    def connection(self):
+        """Checks out a connection, blocking up to ``timeout`` seconds.
+
+        Never blocks on a thread running an event loop; use `acquire` there.
+        """
+        try:
+            asyncio.get_running_loop()
+            on_loop = True
+        except RuntimeError:
+            on_loop = False
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                taken, conn = self._take()
+                if taken:
+                    break
+                remaining = deadline - time.time()
+                if on_loop or remaining <= 0:
+                    raise self._exhausted()
+                self._stats['waits'] += 1
+                self._cond.wait(remaining)
+            self._stats['checkouts'] += 1
+        return self._prepare(conn)
+
+    async def acquire(self):
+        """Checks out a connection, waiting up to ``timeout`` seconds without
+        blocking the IOLoop.  Hand it back with `release()` as usual."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while True:
+            with self._cond:
+                taken, conn = self._take()
+                if taken:
+                    self._stats['checkouts'] += 1
+                    break
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+                self._stats['waits'] += 1
+            try:
+                await asyncio.wait_for(waiter, max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                with self._cond:
+                    try:
+                        self._waiters.remove((loop, waiter))
+                    except ValueError:
+                        # Woken just as we gave up: pass the wakeup on.
+                        self._notify()
+                    raise self._exhausted()
+        # Connecting or pinging blocks; keep it off the IOLoop.
+        return await loop.run_in_executor(self.executor, self._prepare, conn)
+
+    def _notify(self):
+        """Wakes one thread and one coroutine waiting for a connection (lock held)."""
+        self._cond.notify()
+        while self._waiters:
+            loop, waiter = self._waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(_wake, waiter)
+            except RuntimeError:
+                # The waiter's loop is closed
+                continue
+            break
+
+    def _prepare(self, conn):
+        if conn is None:
+            try:
+                conn = Connection(**self._conn_args)
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._notify()
+                raise
+            return conn
+
+        try:
+            self._check(conn)
+        except Exception:
+            self._discard(conn)
+            raise
+        return conn
+
+    def _check(self, conn):
+        idle = time.time() - conn._last_use_time
+        if conn._db is None or idle > self.max_idle_time:
+            self._stats['recycled'] += 1
+            conn.reconnect()
+            conn._last_use_time = time.time()
+        elif idle > self.ping_interval:
+            self._stats['pings'] += 1
+            conn.ping()
+
+    def release(self, conn):
+        """Returns a connection obtained from `connection()` to the pool."""
+        if conn._db is not None:
+            try:
+                # Never hand an open transaction to the next request.  begin()
+                # leaves autocommit on, so ask the server status too.
+                autocommit = conn._db.get_autocommit()
+                if (conn._tx_tags is not None or not autocommit or
+                        conn._db.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS):
+                    conn.rollback()
+                if not autocommit:
+                    conn.autocommit(True)
+            except pymysql.Error:
+                conn.close()
+
+        conn.listener = None
+        with self._cond:
+            if conn._db is None or self._closed:
+                self._size -= 1
+                conn.close()
+            else:
+                self._idle.append(conn)
+            self._stats['checkins'] += 1
+            self._notify()
+
+    def _discard(self, conn):
+        conn.close()
+        with self._cond:
+            self._size -= 1
+            self._notify()
+
+    def close(self):
+        """Closes all idle connections and refuses further checkouts."""
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                self._idle.pop().close()
+                self._size -= 1
+            self._cond.notify_all()
+            while self._waiters:
+                self._notify()
+        self.executor.shutdown(wait=False)
+
+    @property
+    def in_use(self):
+        """Number of connections currently checked out."""
+        return self._size - len(self._idle)
+
+    def stats(self):
+        """Returns a snapshot of pool usage counters."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle),
+                         in_use=self._size - len(self._idle),
+                         min_size=self.min_size, max_size=self.max_size)
+        return stats
 
 
 class Row(dict):
@@ -181,3 +815,98 @@ class Row(dict):
             return self[name]
         except KeyError:
             raise AttributeError(name)
+
+    @classmethod
+    def maker(cls, column_names):
+        """Returns a callable that builds a row from a DB-API value tuple."""
+        return lambda values: cls(zip(column_names, values))
+
+
+class CompactRow:
+    """A read-only row that stores its values in the DB-API tuple.
+
+    All rows of one result set share a single column-name-to-position map,
+    so a row costs one small object plus the tuple pymysql already built,
+    instead of a dict per row.  Columns are accessed like with `Row`
+    (``row.title`` or ``row["title"]``), and ``_asdict()`` returns a plain
+    dict, which is also what `utils.escape.json_encode` serializes.  For
+    large results `columnar` is the faster route to JSON.
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    @classmethod
+    def maker(cls, column_names):
+        """Returns a callable that builds a row from a DB-API value tuple."""
+        index = {name: i for i, name in enumerate(column_names)}
+        return functools.partial(cls, index)
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __getattr__(self, name):
+        if name in CompactRow.__slots__:
+            # Not set yet, e.g. while unpickling.
+            raise AttributeError(name)
+        try:
+            return self._values[self._index[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __eq__(self, other):
+        if isinstance(other, CompactRow):
+            other = other._asdict()
+        return self._asdict() == other
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self._asdict())
+
+    def __getstate__(self):
+        return self._index, self._values
+
+    def __setstate__(self, state):
+        self._index, self._values = state
+
+    def get(self, key, default=None):
+        try:
+            return self._values[self._index[key]]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._index.keys()
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(self._index, self._values)
+
+    def _asdict(self):
+        return dict(zip(self._index, self._values))
+
+
+def columnar(rows):
+    """Returns ``rows`` as ``{"columns": [...], "rows": [[...], ...]}``.
+
+    For `CompactRow` results this reuses the value tuples as they are, so the
+    JSON encoder runs entirely in C and column names are written only once.
+    """
+    if not rows:
+        return {'columns': [], 'rows': []}
+    first = rows[0]
+    if isinstance(first, CompactRow):
+        return {'columns': list(first._index), 'rows': [row._values for row in rows]}
+    return {'columns': list(first), 'rows': [list(row.values()) for row in rows]}
@@ -0,0 +1,138 @@
+import logging
+import threading
+import collections
+import concurrent.futures
+
+import redis
+
+from contrib import serializers
+from contrib.sessioncache import LocalSessionCache
+from utils.text import force_text
+
+
+class LocalUserCache(LocalSessionCache):
+    """`LocalSessionCache` on its own invalidation channel, for `UserCache`."""
+
+    channel = 'user-invalidate'
+
+
+class UserCache:
+    """Caches the user records loaded by `BaseHandler.get_user` across requests.
+
+    A lookup tries an in-process LRU first (`LocalUserCache`, kept for
+    ``local_ttl`` seconds and invalidated through Redis pub/sub), then
+    Redis (``user-<id>``, kept for ``ttl`` seconds), and only then calls the
+    loader.  Concurrent lookups of the same user in one process wait for a
+    single loader call instead of each querying the database.
+
+    Records are stored serialized and decoded for every caller, so a
+    request may modify the user it gets back.  Only truthy records are
+    cached; call `invalidate` whenever a user record changes.
+    """
+
+    key_prefix = 'user-'
+
+    def __init__(self, backend, ttl=300, local_ttl=30, maxsize=10000, serializer='json',
+                 factory=dict):
+        self.backend = backend
+        self.ttl = ttl
+        self.serializer = serializers.get_serializer(serializer)
+        # Turns decoded records back into e.g. torndb.Row
+        self.factory = factory
+        self.local = LocalUserCache(backend, maxsize, local_ttl) if local_ttl else None
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def key(self, user_id):
+        if isinstance(user_id, bytes):
+            # As read from the secure cookie
+            user_id = force_text(user_id)
+        return self.key_prefix + str(user_id)
+
+    def get(self, user_id, loader):
+        """Returns the user record, calling ``loader(user_id)`` on a miss."""
+        key = self.key(user_id)
+        if self.local is not None:
+            hit = self.local.get(key)
+            if hit is not None:
+                self.counters['local_hits'] += 1
+                return self._decode(hit[0])
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = concurrent.futures.Future()
+        if not leader:
+            self.counters['coalesced'] += 1
+            return self._decode(future.result())
+        try:
+            payload = self._fetch(key, user_id, loader)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(payload)
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is future:
+                    del self._inflight[key]
+        return self._decode(payload)
+
+    def _fetch(self, key, user_id, loader):
+        token = self.local.token() if self.local is not None else None
+        try:
+            payload = self.backend.get(key)
+        except redis.RedisError:
+            logging.warning("User cache unavailable, loading %s directly", key, exc_info=True)
+            self.counters['errors'] += 1
+            return self._dumps(loader(user_id))
+        if payload is not None:
+            self.counters['redis_hits'] += 1
+            if self.local is not None:
+                self.local.put(key, payload, self.ttl, token)
+            return payload
+        self.counters['misses'] += 1
+        payload = self._dumps(loader(user_id))
+        if payload is None:
+            return None
+        if self.local is not None and token != self.local.token():
+            # Invalidated while loading: the record may predate the change.
+            return payload
+        try:
+            self.backend.set(key, payload, ex=self.ttl)
+        except redis.RedisError:
+            logging.warning("Cannot cache %s", key, exc_info=True)
+            self.counters['errors'] += 1
+            return payload
+        if self.local is not None:
+            self.local.put(key, payload, self.ttl, token)
+        return payload
+
+    def _dumps(self, user):
+        if not user:
+            return None
+        return serializers.dumps(dict(user), self.serializer)
+
+    def _decode(self, payload):
+        if payload is None:
+            return None
+        return self.factory(serializers.loads(payload, accept_pickle=False))
+
+    def invalidate(self, user_id):
+        """Drops the cached record everywhere; call it after changing a user."""
+        key = self.key(user_id)
+        with self._lock:
+            # Later lookups must not join a load that started before the change
+            self._inflight.pop(key, None)
+        pipe = self.backend.pipeline(transaction=False)
+        pipe.delete(key)
+        if self.local is not None:
+            self.local.invalidate(key, pipe)
+        pipe.execute()
+
+    def stats(self):
+        stats = dict(self.counters)
+        if self.local is not None:
+            stats['local'] = self.local.stats()
+        return stats
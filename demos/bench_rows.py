@@ -0,0 +1,68 @@
+"""Compares torndb.Row with torndb.CompactRow.
+
+Builds the same synthetic result set with both row factories and reports
+the memory held by the rows, the construction time and the time to encode
+them as JSON, both as a list of objects and through `torndb.columnar`.  No database is needed:
+
+    python -m demos.bench_rows --rows=100000 --columns=20
+"""
+import time
+import timeit
+import tracemalloc
+
+from tornado.options import define, options, parse_command_line
+
+from contrib.torndb import Row, CompactRow, columnar
+from utils.escape import json_encode
+
+
+def make_result_set(rows, columns):
+    column_names = ['column_%d' % i for i in range(columns)]
+    values = [tuple(range(r, r + columns)) for r in range(rows)]
+    return column_names, values
+
+
+def build(factory, column_names, values):
+    make_row = factory.maker(column_names)
+    return [make_row(row) for row in values]
+
+
+def measure(factory, column_names, values, repeat):
+    tracemalloc.start()
+    rows = build(factory, column_names, values)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    build_time = min(timeit.repeat(
+        lambda: build(factory, column_names, values), number=1, repeat=repeat))
+
+    start = time.perf_counter()
+    json_encode(rows)
+    json_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    json_encode(columnar(rows))
+    columnar_time = time.perf_counter() - start
+    return size, build_time, json_time, columnar_time
+
+
+def main():
+    define("rows", default=100000, help="rows in the result set", type=int)
+    define("columns", default=20, help="columns per row", type=int)
+    define("repeat", default=5, help="construction timing repeats", type=int)
+    parse_command_line()
+
+    column_names, values = make_result_set(options.rows, options.columns)
+    print("%d rows x %d columns" % (options.rows, options.columns))
+    print("%-12s %12s %12s %12s %14s" % (
+        "factory", "memory MiB", "build ms", "json ms", "columnar ms"))
+    for factory in (Row, CompactRow):
+        size, build_time, json_time, columnar_time = measure(
+            factory, column_names, values, options.repeat)
+        print("%-12s %12.1f %12.1f %12.1f %14.1f" % (
+            factory.__name__, size / 2 ** 20, build_time * 1000,
+            json_time * 1000, columnar_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
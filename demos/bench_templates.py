@@ -0,0 +1,61 @@
+"""Compares Jinja2 render latency with and without a shared Environment.
+
+``per-request`` is what `Jinja2Handler.render_template` used to do: a new
+Environment for every render, so the template is read, parsed and compiled
+each time.  ``bytecode`` also uses a new Environment per render (like the
+first request of a freshly started worker) but loads the compiled code from
+a `FileSystemBytecodeCache`.  ``shared`` is the process-wide Environment from
+`contrib.templating.get_environment`:
+
+    python -m demos.bench_templates --template=base.html --renders=2000
+"""
+import os
+import tempfile
+import timeit
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from tornado.options import define, options, parse_command_line
+
+from contrib.templating import get_environment
+
+TEMPLATE_ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                             'templates')
+
+
+def per_request(template_name):
+    env = Environment(loader=FileSystemLoader([TEMPLATE_ROOT]))
+    return env.get_template(template_name).render()
+
+
+def bytecode(cache, template_name):
+    env = Environment(loader=FileSystemLoader([TEMPLATE_ROOT]), bytecode_cache=cache)
+    return env.get_template(template_name).render()
+
+
+def shared(template_name):
+    return get_environment(TEMPLATE_ROOT).get_template(template_name).render()
+
+
+def main():
+    define("template", default="base.html", help="template to render")
+    define("renders", default=2000, help="renders per measurement", type=int)
+    define("repeat", default=5, help="timing repeats", type=int)
+    parse_command_line()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = FileSystemBytecodeCache(cache_dir)
+        cases = [
+            ("per-request", lambda: per_request(options.template)),
+            ("bytecode", lambda: bytecode(cache, options.template)),
+            ("shared", lambda: shared(options.template)),
+        ]
+        print("%s, %d renders" % (options.template, options.renders))
+        print("%-12s %14s" % ("environment", "us / render"))
+        for name, render in cases:
+            render()
+            best = min(timeit.repeat(render, number=options.renders, repeat=options.repeat))
+            print("%-12s %14.1f" % (name, best / options.renders * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import tornado.web
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """ 健康检查: 进程在模板预编译完成后才监听, 能响应即可用 """
+
+    def get(self):
+        self.finish('ok')
@@ -1,8 +1,10 @@
-import tornado.web
 from tornado import gen
 
+from base import BaseHandler, cache_response
 
-class IndexHandler(tornado.web.RequestHandler):
+
+class IndexHandler(BaseHandler):
+    @cache_response(ttl=60)
     @gen.coroutine
     def get(self):
         self.render("base.html")
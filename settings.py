@@ -3,12 +3,20 @@ import logging
 import logging.handlers
 
 import redis
+import redis.asyncio
 
 import tornado
 import tornado.template
 import tornado.options
 from tornado.options import define, options   
 
+from contrib.sessioncache import LocalSessionCache
+from contrib.usercache import UserCache
+from contrib.permissions import PermissionCache
+from contrib.fragmentcache import FragmentCache
+from contrib.responsecache import ResponseCache
+from contrib.torndb import Row
+
 SECRET_KEY = 'tornado.app'
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -27,10 +35,58 @@ settings = dict(
     template_loader=tornado.template.Loader(TEMPLATE_ROOT),
 )
 
+_session_redis = redis.StrictRedis(host='127.0.0.1', port=6379, db=0)
+
+# Jinja2Handler: 每个进程一个Environment, 编译结果缓存在bytecode_cache_dir, 各worker共享
+# debug为True时才检查模板文件是否修改
+settings['jinja2'] = dict(
+    bytecode_cache_dir=os.path.join(BASE_DIR, '.jinja2_cache'),
+    cache_size=400,
+    # python app.py --compile_templates 预编译为Python模块 (部署时执行一次), 非debug时优先加载
+    compiled_modules_dir=None,
+    # 模板片段缓存: {% cache 'sidebar', 300, vary_user=true %}...{% endcache %}
+    # 用 Jinja2Handler.invalidate_fragments(prefix) 按key前缀清除
+    fragment_cache=FragmentCache(_session_redis, maxsize=1000, local_ttl=30),
+)
+
+# 匿名GET请求的整页缓存, 见 base.cache_response; 按路径前缀清除: invalidate('/news')
+settings['response_cache'] = ResponseCache(_session_redis, maxsize=1000, local_ttl=10)
+
 settings['session'] = dict(
+    # redis: session存储在Redis; cookie: 加密后存在cookie中, 超过cookie_max_bytes时转存Redis
+    mode='redis',
+    cookie_max_bytes=3000,
     session_id_name='token',
     expire_seconds=60 * 60 * 1,
-    backend=redis.StrictRedis(host='127.0.0.1', port=6379, db=0),
+    refresh_fraction=0.5,  # 剩余有效期低于该比例时才续期
+    max_sessions_per_user=None,  # 每个用户最多同时有效的session数, None为不限制
+    backend=_session_redis,
+    # 进程内session缓存, 各worker之间通过Redis pub/sub失效
+    local_cache=LocalSessionCache(_session_redis, maxsize=10000, ttl=30),
+    # BaseHandler.get_session() 使用的异步客户端, 有独立的连接池
+    async_backend=redis.asyncio.StrictRedis(connection_pool=redis.asyncio.ConnectionPool(
+        host='127.0.0.1', port=6379, db=0, max_connections=50)),
+    storage='hash',  # string: 整体序列化; hash: 只写入修改过的key
+    serializer='json',  # json / msgpack / pickle
+    accept_pickle=True,  # 兼容读取旧的pickle数据, 迁移完成后关闭
+)
+
+# get_current_user的用户缓存: 进程内LRU -> Redis -> get_user
+# 修改用户信息后调用 BaseHandler.invalidate_user(user_id)
+settings['user_cache'] = UserCache(_session_redis, ttl=300, local_ttl=30, maxsize=10000,
+                                   factory=Row)
+
+# 用户权限缓存, 角色变化后调用 BaseHandler.invalidate_permissions()
+settings['permission_cache'] = PermissionCache(_session_redis, ttl=3600)
+
+# 密码hash进程池: 每个app进程各有一个, workers默认为 CPU核数 // processes
+# 排队任务超过max_pending时直接返回503; 修改rounds后, 用户下次登录时自动重新计算hash
+settings['password_hasher'] = dict(
+    rounds=12,
+    processes=4,  # 本机app进程数, 与supervisord.conf中的program数一致
+    workers=None,
+    max_pending=64,
+    retry_after=1,
 )
 
 settings['database'] = dict(
@@ -38,6 +94,20 @@ settings['database'] = dict(
     db='db',
     user='user',
     password='***',
+    min_size=1,
+    max_size=10,
+    # 开启查询结果缓存: db.cached(ttl=...).query(...)
+    query_cache=dict(ttl=60),
+    # 读写分离: 只读查询分发到从库, 写入后sticky_seconds秒内该客户端读主库
+    replicas=[
+        # dict(host='127.0.0.2'),
+    ],
+    replica_strategy='round_robin',  # 或 least_connections
+    replica_max_lag=5,
+    replica_health_check_interval=10,
+    sticky_seconds=5,
+    # SQL统计: 慢查询日志与N+1检测, 设为None关闭
+    instrument=dict(slow_threshold=0.5, n_plus_one_threshold=5),
 )
 
 settings['media'] = dict(
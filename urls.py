@@ -1,5 +1,7 @@
 from handlers.foo import FooHandler
+from handlers.health import HealthHandler
 
 url_patterns = [
     (r"/foo", FooHandler),
+    (r"/healthz", HealthHandler),
 ]
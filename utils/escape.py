@@ -4,10 +4,12 @@ from datetime import datetime, date
 
 class JsonEncoder(json.JSONEncoder):
     """
-    支持datetime和date类型的编码
+    支持datetime和date类型的编码, 以及带有_asdict()的行对象(如CompactRow)
     """
     def default(self, obj):
-        if isinstance(obj, datetime):
+        if hasattr(obj, '_asdict'):
+            return obj._asdict()
+        elif isinstance(obj, datetime):
             return obj.strftime('%Y-%m-%d %H:%M:%S')
         elif isinstance(obj, date):
             return obj.strftime('%Y-%m-%d')
@@ -1,6 +1,98 @@
+import re
+import functools
+
+
+# `:name` placeholders; a leading colon or word character (`::`, `10:30`)
+# means the colon is part of the SQL text.
+_PLACEHOLDER = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_where(sql, arity):
+    """Compiles a `Query.where` clause into DB-API ``%s`` form.
+
+    ``arity`` is a sorted tuple of ``(name, n)`` pairs where ``n`` is the
+    length of a list/tuple argument (an IN list) or None for a scalar.
+    Returns the clause and the names in the order their values must be
+    passed to the driver.
+    """
+    arities = dict(arity)
+    names = []
+
+    def replace(match):
+        name = match.group(1)
+        if name not in arities:
+            return match.group(0)
+        names.append(name)
+        n = arities[name]
+        if n is None:
+            return '%s'
+        return '(%s)' % ', '.join(['%s'] * n)
+
+    return '(%s)' % _PLACEHOLDER.sub(replace, sql), tuple(names)
+
+
+def parse_order_by(columns):
+    """Splits ``["a.created DESC", "a.id"]`` into ``[("a.created", True), ("a.id", False)]``."""
+    keys = []
+    for column in columns:
+        parts = column.split()
+        desc = len(parts) > 1 and parts[-1].upper() == 'DESC'
+        if len(parts) > 1 and parts[-1].upper() in ('ASC', 'DESC'):
+            parts = parts[:-1]
+        keys.append((' '.join(parts), desc))
+    return keys
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_seek(keys):
+    """``(a > x) OR (a = x AND b > y) ...`` for a tuple of (column, desc) keys."""
+    alternatives = []
+    for i, (column, desc) in enumerate(keys):
+        terms = ['%s = %%s' % c for c, _ in keys[:i]]
+        terms.append('%s %s %%s' % (column, '<' if desc else '>'))
+        alternatives.append('(%s)' % ' AND '.join(terms))
+    return '(%s)' % ' OR '.join(alternatives)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_select(distinct, select, table, join, where, order_by):
+    sql = 'SELECT %s %s FROM %s %s' % (
+        'DISTINCT' if distinct else '', ', '.join(select), table, ' '.join(join))
+    if where:
+        sql += ' WHERE %s' % ' AND '.join(where)
+    if order_by is not None:
+        sql += ' ORDER BY %s' % ', '.join(order_by)
+    return sql
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_count(distinct, column, _as, table, join, where):
+    distinct = 'DISTINCT ' if distinct else ''
+    if _as:
+        select = f'COUNT({distinct}{column}) AS {_as}'
+    else:
+        select = f'COUNT({distinct}{column})'
+    if where:
+        join = ' '.join(join)
+        where = ' AND '.join(where)
+        return f'SELECT {select} FROM {table} {join} WHERE {where}'
+    i = table.find(' ')
+    if i == -1:
+        return f'SELECT {select} FROM {table}'
+    return 'SELECT %s FROM %s' % (select, table[0:i])
 
 
 class Query:
+    """Builds a SELECT statement and its parameter list.
+
+    Placeholders in `where` clauses are compiled once per clause shape (the
+    SQL text plus which arguments are IN lists, and how long) and the
+    compiled statements are cached process-wide, so rebuilding the same
+    query on every request costs a few dictionary lookups.  The statement
+    text only depends on that shape and on limit/offset, which keeps it
+    stable enough for server-side prepared statements.
+    """
     def __init__(self, table, limit=None, offset=None,
                  order_by=None, distinct_on=None):
         self._select = []
@@ -12,53 +104,74 @@ class Query:
         self._limit = limit
         self._offset = offset
         self._distinct_on = distinct_on
+        self._sql = None
 
     def select(self, column):
         if isinstance(column, (list, tuple)):
             self._select.extend(column)
         else:
             self._select.append(column)
+        self._sql = None
 
     def where(self, sql, **kwargs):
-        for k, v in kwargs.items():
+        arity = tuple(sorted(
+            (k, len(v) if isinstance(v, (list, tuple)) else None)
+            for k, v in kwargs.items()
+        ))
+        clause, names = _compile_where(sql, arity)
+        for name in names:
+            v = kwargs[name]
             if isinstance(v, (list, tuple)):
-                sql = sql.replace(':' + k, '(%s)' % ', '.join(['%s' for _ in v]))
                 self._params.extend(v)
             else:
-                sql = sql.replace(':' + k, '%s')
                 self._params.append(v)
-        self._where.append('(%s)' % sql)
+        self._where.append(clause)
+        self._sql = None
 
     def join(self, clause):
         if clause not in self._join:
             self._join.append(clause)
+            self._sql = None
 
     def count(self, column='*', _as=None):
-        distinct = 'DISTINCT ' if self._distinct_on else ''
-        if _as:
-            select = f'COUNT({distinct}{column}) AS {_as}'
-        else:
-            select = f'COUNT({distinct}{column})'
-        if self._where:
-            join = ' '.join(self._join)
-            where = ' AND '.join(self._where)
-            sql = f'SELECT {select} FROM {self._from} {join} WHERE {where}'
-        else:
-            i = self._from.find(' ')
-            if i == -1:
-                sql = f'SELECT {select} FROM {self._from}'
-            else:
-                sql = 'SELECT %s FROM %s' % (select, self._from[0:i])
+        sql = _compile_count(bool(self._distinct_on), column, _as, self._from,
+                             tuple(self._join), tuple(self._where))
         return sql, self._params
 
     def order_by(self, columns):
         self._order_by = columns
+        self._sql = None
+
+    def seek(self, values, reverse=False):
+        """Restricts the query to the rows that sort after ``values``.
+
+        This is keyset ("seek") pagination: ``values`` are the `order_by`
+        column values of the last row already seen, so the database can
+        start from an index position instead of skipping OFFSET rows.  The
+        ordering must be total (end with a unique column) and the columns
+        must not be NULL.  With ``reverse`` the rows *before* ``values`` are
+        selected and the ordering is flipped; callers reverse the page.
+        """
+        keys = self.ordering
+        if len(values) != len(keys):
+            raise ValueError('seek() needs one value per order_by column')
+        if reverse:
+            keys = [(column, not desc) for column, desc in keys]
+            self._order_by = ['%s %s' % (column, 'DESC' if desc else 'ASC')
+                              for column, desc in keys]
+        self._where.append(_compile_seek(tuple(keys)))
+        for i, value in enumerate(values):
+            self._params.extend(values[:i])
+            self._params.append(value)
+        self._sql = None
 
     def limit(self, val):
         self._limit = val
+        self._sql = None
 
     def offset(self, val):
         self._offset = val
+        self._sql = None
 
     @property
     def sql(self):
@@ -68,22 +181,32 @@ class Query:
     def params(self):
         return self._params
 
+    @property
+    def table(self):
+        """The first table name in the FROM clause, without alias."""
+        return self._from.split()[0]
+
+    @property
+    def ordering(self):
+        """The ORDER BY columns as ``(column, descending)`` pairs."""
+        return parse_order_by(self._order_by or [])
+
+    @property
+    def filtered(self):
+        return bool(self._where)
+
     def __str__(self):
-        select = ', '.join(self._select)
-        join = ' '.join(self._join)
-        distinct = 'DISTINCT' if self._distinct_on else ''
-        where = ' AND '.join(self._where)
-        sql = f'SELECT {distinct} {select} FROM {self._from} {join}'
-        if where:
-            sql += f' WHERE {where}'
-        if self._order_by is not None:
-            _ob = ', '.join(self._order_by)
-            sql += ' ORDER BY %s' % _ob
-        if self._limit is not None:
-            sql += ' LIMIT %s' % self._limit
-        if self._offset is not None:
-            sql += ' OFFSET %s' % self._offset
-        return sql
+        if self._sql is None:
+            order_by = None if self._order_by is None else tuple(self._order_by)
+            sql = _compile_select(bool(self._distinct_on), tuple(self._select),
+                                  self._from, tuple(self._join),
+                                  tuple(self._where), order_by)
+            if self._limit is not None:
+                sql += ' LIMIT %s' % self._limit
+            if self._offset is not None:
+                sql += ' OFFSET %s' % self._offset
+            self._sql = sql
+        return self._sql
 
     def __iter__(self):
         yield str(self)